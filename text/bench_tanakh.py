@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import sys
+import os
+import time
+import json
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+import massage_tanakh
+
+
+default_indir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tanach.us', 'Books')
+
+default_booknames = ["Psalms", "Isaiah", "Jeremiah"]
+
+phase_names = ["parse", "tokenize", "mangle", "dump"]
+
+
+########################################
+##
+## Parser backends
+##
+########################################
+def timeParse(bookname, indir, parser_backend):
+    infilename = os.path.join(indir, '%s.xml' % bookname)
+    handler = massage_tanakh.TanakhHandler(bookname)
+    fin = open(infilename, "rb")
+    start = time.perf_counter()
+    massage_tanakh.parseBook(fin, handler, parser_backend)
+    elapsed = time.perf_counter() - start
+    fin.close()
+    return elapsed
+
+
+def benchmarkParsers(booknames, indir, parser_backends, repeat):
+    # Best of `repeat` runs, per book and backend.
+    result = {}
+    for parser_backend in parser_backends:
+        result[parser_backend] = {}
+        for bookname in booknames:
+            result[parser_backend][bookname] = min([timeParse(bookname, indir, parser_backend) for i in range(repeat)])
+    return result
+
+
+########################################
+##
+## Pipeline phases
+##
+########################################
+class CountingSink:
+    # Stands in for the MQL file, so that dumping is timed without
+    # the disk and without keeping the output around.
+    def __init__(self):
+        self.count = 0
+
+    def write(self, b):
+        self.count += len(b)
+
+
+def resetPeakRSS():
+    # Writing 5 to clear_refs resets VmHWM to the current RSS (Linux
+    # only), so that the peak read after a phase is that phase's own.
+    # Returns False if it cannot be reset.
+    try:
+        fout = open("/proc/self/clear_refs", "w")
+        fout.write("5")
+        fout.close()
+        return True
+    except OSError:
+        return False
+
+
+def getPeakRSS():
+    # VmHWM in KiB, or None where there is no /proc.
+    try:
+        fin = open("/proc/self/status", "r")
+    except OSError:
+        return None
+    result = None
+    for line in fin:
+        if line.startswith("VmHWM:"):
+            result = int(line.split()[1])
+    fin.close()
+    return result
+
+
+def makePhase(elapsed, words, nbytes, bPeakReset):
+    return {
+        "wall_s" : elapsed,
+        "words" : words,
+        "bytes" : nbytes,
+        "words_per_s" : words / elapsed if elapsed > 0 else None,
+        "bytes_per_s" : nbytes / elapsed if elapsed > 0 else None,
+        "peak_rss_kb" : getPeakRSS() if bPeakReset else None,
+    }
+
+
+def benchmarkBook(bookname, indir, parser_backend):
+    # Runs in a process of its own (see benchmarkPhases), so that the
+    # peak RSS of each phase belongs to this book alone.  The peak is
+    # reset before each phase.
+    infilename = os.path.join(indir, '%s.xml' % bookname)
+    phases = {}
+
+    # Parsing, which includes everything TanakhHandler does on the way.
+    handler = massage_tanakh.TanakhHandler(bookname)
+    fin = open(infilename, "rb")
+    bPeakReset = resetPeakRSS()
+    start = time.perf_counter()
+    massage_tanakh.parseBook(fin, handler, parser_backend)
+    elapsed = time.perf_counter() - start
+    fin.close()
+    words = len(handler.tokens)
+    phases["parse"] = makePhase(elapsed, words, os.path.getsize(infilename), bPeakReset)
+
+    # handleChars/tokenize_on_whitespace/addWordTokens, replayed over
+    # the text of every word on a fresh handler.
+    texts = list(handler.tokens.surfaces[i] for i in range(words))
+    replay = massage_tanakh.TanakhHandler(bookname)
+    replay.bInW = True
+    bPeakReset = resetPeakRSS()
+    start = time.perf_counter()
+    for text in texts:
+        replay.handleChars(text, "w", True)
+        replay.addWordTokens("".join(replay.wordcharstack))
+        replay.wordcharstack = []
+    elapsed = time.perf_counter() - start
+    phases["tokenize"] = makePhase(elapsed, words, sum([len(text.encode('utf-8')) for text in texts]), bPeakReset)
+
+    # mangleMQLString over every string dumpMQL would mangle, from a
+    # cold cache.
+    values = list(texts)
+    for objectTypeName in handler.objects:
+        for obj in handler.objects[objectTypeName]:
+            values.extend(obj.stringFeatures.values())
+    massage_tanakh.mangleMQLString.cache_clear()
+    mangle = massage_tanakh.mangleMQLString
+    bPeakReset = resetPeakRSS()
+    start = time.perf_counter()
+    for value in values:
+        mangle(value)
+    elapsed = time.perf_counter() - start
+    phases["mangle"] = makePhase(elapsed, words, sum([len(value.encode('utf-8')) for value in values]), bPeakReset)
+
+    # dumpMQL, again from a cold cache.
+    massage_tanakh.mangleMQLString.cache_clear()
+    sink = CountingSink()
+    bPeakReset = resetPeakRSS()
+    start = time.perf_counter()
+    handler.dumpMQL(sink)
+    elapsed = time.perf_counter() - start
+    phases["dump"] = makePhase(elapsed, words, sink.count, bPeakReset)
+
+    return {"book" : bookname, "phases" : phases}
+
+
+def benchmarkPhases(booknames, indir, parser_backend):
+    results = []
+    for bookname in booknames:
+        pool = multiprocessing.Pool(1)
+        try:
+            results.append(pool.apply(benchmarkBook, (bookname, indir, parser_backend)))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+########################################
+##
+## Comparing runs
+##
+########################################
+def compareRuns(old, new):
+    # Yields (book, phase, old wall time, new wall time) for every
+    # book and phase the two runs have in common.
+    old_books = dict([(book["book"], book) for book in old["books"]])
+    for book in new["books"]:
+        if book["book"] not in old_books:
+            continue
+        for phase_name in phase_names:
+            old_phase = old_books[book["book"]]["phases"].get(phase_name)
+            new_phase = book["phases"].get(phase_name)
+            if old_phase != None and new_phase != None:
+                yield (book["book"], phase_name, old_phase["wall_s"], new_phase["wall_s"])
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmarks for the UXLC conversion.")
+    subparsers = argparser.add_subparsers(dest="command")
+
+    phases_parser = subparsers.add_parser("phases", help="time parse, tokenize, mangle and dump per book, as JSON (the default)")
+    phases_parser.add_argument("-b", "--books", action="append", default=[],
+                               help="books to benchmark, as for massage_tanakh.py (default: %s)" % ",".join(default_booknames))
+    phases_parser.add_argument("--indir", default=default_indir)
+    phases_parser.add_argument("--parser", dest="parser_backend", choices=massage_tanakh.parser_backends, default="expat")
+    phases_parser.add_argument("-o", "--output", help="JSON file to write (default: stdout)")
+
+    parsers_parser = subparsers.add_parser("parsers", help="compare the parser backends")
+    parsers_parser.add_argument("--indir", default=default_indir)
+    parsers_parser.add_argument("--repeat", type=int, default=3)
+    parsers_parser.add_argument("--parser", dest="parser_backends", action="append", choices=massage_tanakh.parser_backends)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two JSON results of 'phases'")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    if len(sys.argv) < 2 or sys.argv[1] not in subparsers.choices and sys.argv[1] not in ["-h", "--help"]:
+        args = argparser.parse_args(["phases"] + sys.argv[1:])
+    else:
+        args = argparser.parse_args()
+
+    if args.command == "parsers":
+        parser_backends = args.parser_backends
+        if parser_backends == None:
+            parser_backends = [b for b in massage_tanakh.parser_backends if b != "lxml" or massage_tanakh.lxml_etree != None]
+
+        timings = benchmarkParsers(massage_tanakh.booknames_Tanakh, args.indir, parser_backends, args.repeat)
+
+        baseline = parser_backends[0]
+        sys.stdout.write("%-10s %12s %12s %8s\n" % ("parser", "Psalms [s]", "Tanakh [s]", "speedup"))
+        for parser_backend in parser_backends:
+            psalms = timings[parser_backend]["Psalms"]
+            tanakh = sum(timings[parser_backend].values())
+            speedup = sum(timings[baseline].values()) / tanakh
+            sys.stdout.write("%-10s %12.3f %12.3f %7.2fx\n" % (parser_backend, psalms, tanakh, speedup))
+    elif args.command == "compare":
+        old = json.load(open(args.old))
+        new = json.load(open(args.new))
+        sys.stdout.write("%-14s %-9s %10s %10s %8s\n" % ("book", "phase", "old [s]", "new [s]", "ratio"))
+        for (bookname, phase_name, old_s, new_s) in compareRuns(old, new):
+            sys.stdout.write("%-14s %-9s %10.4f %10.4f %7.2fx\n" % (bookname, phase_name, old_s, new_s, new_s / old_s))
+    else:
+        if len(args.books) == 0:
+            args.books = [",".join(default_booknames)]
+        try:
+            booknames = massage_tanakh.selectBooks(args.books, args.indir, False)
+        except ValueError as e:
+            argparser.error(str(e))
+
+        run = {
+            "commit" : getCommit(),
+            "python" : platform.python_version(),
+            "parser" : args.parser_backend,
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "books" : benchmarkPhases(booknames, args.indir, args.parser_backend),
+        }
+
+        if args.output != None:
+            fout = open(args.output, "w")
+        else:
+            fout = sys.stdout
+        json.dump(run, fout, indent=2)
+        fout.write("\n")
+        if args.output != None:
+            fout.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+#
+# Approximate advance widths of a book-face Hebrew font, for laying
+# out without a font library (see MetricFileSource in
+# layout_tanakh.py).  Points, accents and joiners not listed here do
+# not advance; anything else not listed advances by default_advance.
+#
+units_per_em = 1000
+
+default_advance = 500
+
+advances = {
+    0x05d0 : 640, # alef
+    0x05d1 : 600, # bet
+    0x05d2 : 420, # gimel
+    0x05d3 : 560, # dalet
+    0x05d4 : 620, # he
+    0x05d5 : 300, # vav
+    0x05d6 : 330, # zayin
+    0x05d7 : 620, # het
+    0x05d8 : 620, # tet
+    0x05d9 : 300, # yod
+    0x05da : 560, # final kaf
+    0x05db : 560, # kaf
+    0x05dc : 560, # lamed
+    0x05dd : 620, # final mem
+    0x05de : 640, # mem
+    0x05df : 300, # final nun
+    0x05e0 : 420, # nun
+    0x05e1 : 600, # samekh
+    0x05e2 : 600, # ayin
+    0x05e3 : 580, # final pe
+    0x05e4 : 580, # pe
+    0x05e5 : 560, # final tsadi
+    0x05e6 : 580, # tsadi
+    0x05e7 : 600, # qof
+    0x05e8 : 560, # resh
+    0x05e9 : 720, # shin
+    0x05ea : 660, # tav
+    0x05be : 380, # maqqef
+    0x05c0 : 240, # paseq
+    0x05c3 : 300, # sof pasuq
+    0x05c6 : 360, # nun hafukha
+    0x0020 : 260, # space
+}
@@ -0,0 +1,691 @@
+# -*- coding: utf-8 -*-
+import sys
+import os
+import time
+import pickle
+import hashlib
+import bisect
+import argparse
+import functools
+import multiprocessing
+import array
+import mmap
+import struct
+
+import massage_tanakh
+
+try:
+    import uharfbuzz as hb
+except ImportError:
+    hb = None
+
+
+default_indir = os.path.join(massage_tanakh.script_dir, 'tanach.us', 'Books')
+default_cachedir = os.path.join(massage_tanakh.script_dir, "massage_cache")
+default_metricsfilename = os.path.join(massage_tanakh.script_dir, "fallback_metrics.py")
+
+
+########################################
+##
+## Measuring
+##
+########################################
+#
+# Widths are in letters: a letter (or anything that is not Hebrew) is
+# one, maqqef and sof pasuq half of one, points, accents and joiners
+# nothing.
+class_widths = {
+    "letter" : 1.0,
+    "punctuation" : 0.5,
+    "point" : 0.0,
+    "accent" : 0.0,
+    "joiner" : 0.0,
+}
+
+@functools.lru_cache(maxsize=65536)
+def measureSurface(surface):
+    width = 0.0
+    for c in surface:
+        codepoint_class = massage_tanakh.surface_codepoint_classes.get(ord(c))
+        if codepoint_class == None:
+            width += 1.0
+        else:
+            width += class_widths[codepoint_class]
+    return width
+
+
+########################################
+##
+## Glyph metrics
+##
+########################################
+#
+# Real widths, for a font at a size with a set of OpenType features,
+# come from a metric source: a font shaped with HarfBuzz (if uharfbuzz
+# is installed), or a plain-Python metric file such as
+# fallback_metrics.py.  Each distinct surface is measured once per
+# (source, size, features); the widths are kept in a table on disk,
+#
+#   magic (8 bytes) | count (u64) | hashes (count u64, sorted)
+#   | widths (count f64)
+#
+# which is read through mmap, so a later run measures nothing it has
+# measured before.  A surface is known by the first 8 bytes of its
+# BLAKE2b hash.
+#
+metrics_magic = b"WLCMET\x00\x01"
+
+def getSurfaceHash(surface):
+    return int.from_bytes(hashlib.blake2b(surface.encode('utf-8'), digest_size=8).digest(), "little")
+
+
+class MetricFileSource:
+    # A Python file setting units_per_em, default_advance and advances,
+    # a dict from codepoint to advance.  Codepoints not in advances
+    # advance by default_advance, except the combining marks, which do
+    # not advance.  Features are ignored.
+    def __init__(self, filename):
+        fin = open(filename, "r", encoding="utf-8")
+        text = fin.read()
+        fin.close()
+        namespace = {}
+        exec(compile(text, filename, "exec"), namespace)
+        self.units_per_em = namespace["units_per_em"]
+        self.default_advance = namespace["default_advance"]
+        self.advances = namespace["advances"]
+        self.identity = "metrics:" + hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def getIdentity(self):
+        return self.identity
+
+    def measure(self, surface, size, features):
+        advance = 0
+        for c in surface:
+            codepoint = ord(c)
+            if codepoint in self.advances:
+                advance += self.advances[codepoint]
+            elif massage_tanakh.surface_codepoint_classes.get(codepoint) not in ["point", "accent", "joiner"]:
+                advance += self.default_advance
+        return advance * size / self.units_per_em
+
+
+class HarfBuzzSource:
+    # A font file, shaped right-to-left with HarfBuzz.  features maps
+    # OpenType feature tags to True or False.
+    def __init__(self, filename):
+        if hb == None:
+            raise Exception("ERROR: Measuring with a font needs uharfbuzz, which is not installed.  Use a metric file instead.")
+        fin = open(filename, "rb")
+        data = fin.read()
+        fin.close()
+        self.face = hb.Face(hb.Blob(data))
+        self.font = hb.Font(self.face)
+        self.identity = "font:" + hashlib.sha1(data).hexdigest()
+
+    def getIdentity(self):
+        return self.identity
+
+    def measure(self, surface, size, features):
+        buf = hb.Buffer()
+        buf.add_str(surface)
+        buf.guess_segment_properties()
+        hb.shape(self.font, buf, features)
+        advance = sum([position.x_advance for position in buf.glyph_positions])
+        return advance * size / self.face.upem
+
+
+class MetricsTable:
+    # The widths in one table file, plus those measured since it was
+    # read, until save() writes them all back.
+    def __init__(self, filename):
+        if sys.byteorder != "little":
+            raise Exception("ERROR: Reading %s in place needs a little-endian machine." % filename)
+        self.filename = filename
+        self.added = {}
+        self.open()
+
+    def open(self):
+        self.f = None
+        self.mm = None
+        self.hashes = []
+        self.widths = []
+        if not os.path.exists(self.filename):
+            return
+        self.f = open(self.filename, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_length = len(metrics_magic)
+        if bytes(self.mm[0:magic_length]) != metrics_magic:
+            self.close()
+            raise Exception("ERROR: %s is not a metrics table." % self.filename)
+        (count,) = struct.unpack("<Q", self.mm[magic_length:magic_length+8])
+        pos = magic_length + 8
+        view = memoryview(self.mm)
+        self.hashes = view[pos:pos+8*count].cast('Q')
+        self.widths = view[pos+8*count:pos+16*count].cast('d')
+        view.release()
+
+    def close(self):
+        if self.mm != None:
+            self.hashes.release()
+            self.widths.release()
+            self.hashes = []
+            self.widths = []
+            self.mm.close()
+            self.f.close()
+            self.mm = None
+            self.f = None
+
+    def get(self, surface_hash):
+        # The width, or None if it has not been measured.
+        index = bisect.bisect_left(self.hashes, surface_hash)
+        if index < len(self.hashes) and self.hashes[index] == surface_hash:
+            return self.widths[index]
+        return self.added.get(surface_hash)
+
+    def add(self, surface_hash, width):
+        self.added[surface_hash] = width
+
+    def __len__(self):
+        return len(self.hashes) + len(self.added)
+
+    def save(self):
+        if len(self.added) == 0:
+            return
+        widths = dict(zip(self.hashes, self.widths))
+        widths.update(self.added)
+        hashes = sorted(widths.keys())
+        try:
+            with massage_tanakh.atomicOutput(self.filename) as fout:
+                fout.write(metrics_magic + struct.pack("<Q", len(hashes)))
+                fout.write(array.array('Q', hashes).tobytes())
+                fout.write(array.array('d', [widths[h] for h in hashes]).tobytes())
+                # The old table has to be unmapped before it is replaced.
+                self.close()
+            self.added = {}
+        finally:
+            # Map whichever table is now on disk; on failure the
+            # unsaved widths stay in added.
+            self.open()
+
+
+class GlyphMetrics:
+    # measure() is a drop-in for measureSurface, in points.
+    def __init__(self, source, size, features=None, cachedir=default_cachedir):
+        if features == None:
+            features = {}
+        self.source = source
+        self.size = size
+        self.features = features
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        key = hashlib.sha1(repr((source.getIdentity(), size, sorted(features.items()))).encode('utf-8')).hexdigest()
+        self.table = MetricsTable(os.path.join(cachedir, "metrics.%s.bin" % key))
+        self.measured = 0
+
+    def measure(self, surface):
+        surface_hash = getSurfaceHash(surface)
+        width = self.table.get(surface_hash)
+        if width == None:
+            width = self.source.measure(surface, self.size, self.features)
+            self.table.add(surface_hash, width)
+            self.measured += 1
+        return width
+
+    def save(self):
+        self.table.save()
+
+    def close(self):
+        self.table.close()
+
+
+def parseFeatures(spec):
+    # "kern,-liga" -> {"kern" : True, "liga" : False}
+    features = {}
+    for tag in spec.split(","):
+        tag = tag.strip()
+        if tag.startswith("-"):
+            features[tag[1:]] = False
+        elif tag != "":
+            features[tag.lstrip("+")] = True
+    return features
+
+
+########################################
+##
+## Paragraph blocks
+##
+########################################
+#
+# A block is what gets broken into lines in one go: the paragraphs up
+# to and including one that ends in a petuchah (or the end of a book).
+# A paragraph that ends in a setumah runs on in the same block, with a
+# setumah gap after it.  Each paragraph is (class, groups), and each
+# group is the words a maqqef joins, as (token indexes, text), which is
+# never split over two lines.
+maqqef = "־"
+
+def getParagraphBlocks(paragraphs, tokens, hidden=None):
+    # paragraphs are paragraph SRObjects, tokens a TokenStore.  Tokens
+    # whose monads are in hidden (e.g., the ketiv in qere mode, see
+    # KetivQereTable) are left out.
+    monads = tokens.monads
+    surfaces = tokens.surfaces
+    blocks = []
+    block = []
+    for paragraph in sorted(paragraphs, key=lambda obj: obj.fm):
+        start = bisect.bisect_left(monads, paragraph.fm)
+        end = bisect.bisect_right(monads, paragraph.lm)
+        groups = []
+        bJoined = False
+        for index in range(start, end):
+            monad = monads[index]
+            if hidden != None and monad in hidden:
+                continue
+            surface = surfaces[index]
+            if bJoined:
+                (indexes, text) = groups[-1]
+                indexes.append(index)
+                groups[-1] = (indexes, text + surface)
+            else:
+                groups.append(([index], surface))
+            bJoined = surface.endswith(maqqef)
+        paragraph_class = paragraph.getStringFeature("class")
+        if len(groups) != 0:
+            block.append((paragraph_class, groups))
+        if paragraph_class != "samekh" and len(block) != 0:
+            blocks.append(block)
+            block = []
+    if len(block) != 0:
+        blocks.append(block)
+    return blocks
+
+
+def getTokenWidths(tokens, measure=measureSurface):
+    # The width of every token, measuring each distinct surface once.
+    surfaces = tokens.surfaces
+    code_widths = [measure(surface) for surface in surfaces.values]
+    return array.array('d', [code_widths[code] for code in surfaces.codes])
+
+
+def getBlockWidths(block, token_widths):
+    # What the line breaker needs of a block: per paragraph, its class
+    # and the widths of its groups.
+    return tuple([(paragraph_class, tuple([sum([token_widths[index] for index in indexes]) for (indexes, text) in groups])) for (paragraph_class, groups) in block])
+
+
+########################################
+##
+## Knuth-Plass line breaking
+##
+########################################
+#
+# The total-fit algorithm of Knuth and Plass (1981), with its active
+# list: a breakpoint is only tried against the nodes still active, and
+# a node drops out as soon as a line from it would be overfull, so the
+# work per breakpoint stays bounded by the number of words on a line.
+#
+# Items are boxes (groups), glue (the spaces between them) and penalties
+# (possible breaks).  A setumah is
+#
+#   penalty(0)  box(0)  penalty(inf)  glue(setumah)
+#
+# so that it is a gap in the line, or, if the line breaks there, an
+# indent at the start (the right) of the next line.  A petuchah ends
+# the block the usual way, with the rest of the last line left empty.
+box = 0
+glue = 1
+penalty = 2
+
+infinity = 10000
+finishing_stretch = 1e6
+
+class BreakNode:
+    __slots__ = ["position", "fitness", "total_width", "total_stretch", "total_shrink", "demerits", "ratio", "previous"]
+
+    def __init__(self, position, fitness, total_width, total_stretch, total_shrink, demerits, ratio, previous):
+        self.position = position
+        self.fitness = fitness
+        self.total_width = total_width
+        self.total_stretch = total_stretch
+        self.total_shrink = total_shrink
+        self.demerits = demerits
+        self.ratio = ratio
+        self.previous = previous
+
+
+class LineBreaker:
+    def __init__(self, line_width, space=0.5, stretch=0.25, shrink=0.15, setumah=9.0, tolerance=3.0, line_penalty=10, flagged_demerits=100, fitness_demerits=100):
+        self.line_width = line_width
+        self.space = space
+        self.stretch = stretch
+        self.shrink = shrink
+        self.setumah = setumah
+        self.tolerance = tolerance
+        self.line_penalty = line_penalty
+        self.flagged_demerits = flagged_demerits
+        self.fitness_demerits = fitness_demerits
+        self.cache = {}
+        self.used = set()
+        self.bCacheChanged = False
+
+    def getParams(self):
+        return (self.line_width, self.space, self.stretch, self.shrink, self.setumah, self.tolerance, self.line_penalty, self.flagged_demerits, self.fitness_demerits)
+
+    def getItems(self, block_widths):
+        # Parallel lists of kind, width, stretch, shrink, penalty, and
+        # the group number of each box (-1 for a setumah's empty box).
+        kinds = []
+        widths = []
+        stretches = []
+        shrinks = []
+        penalties = []
+        groups = []
+
+        def add(kind, width, stretch, shrink, penalty_value, group):
+            kinds.append(kind)
+            widths.append(width)
+            stretches.append(stretch)
+            shrinks.append(shrink)
+            penalties.append(penalty_value)
+            groups.append(group)
+
+        group = 0
+        for (paragraph_index, (paragraph_class, group_widths)) in enumerate(block_widths):
+            for (index, width) in enumerate(group_widths):
+                if index > 0:
+                    add(glue, self.space, self.stretch, self.shrink, 0, -1)
+                add(box, width, 0, 0, 0, group)
+                group += 1
+            if paragraph_class == "samekh" and paragraph_index + 1 < len(block_widths):
+                add(penalty, 0, 0, 0, 0, -1)
+                add(box, 0, 0, 0, 0, -1)
+                add(penalty, 0, 0, 0, infinity, -1)
+                add(glue, self.setumah, 0, 0, 0, -1)
+        add(penalty, 0, 0, 0, infinity, -1)
+        add(glue, 0, finishing_stretch, 0, 0, -1)
+        add(penalty, 0, 0, 0, -infinity, -1)
+        return (kinds, widths, stretches, shrinks, penalties, groups)
+
+    def breakItems(self, items):
+        # Returns the positions of the chosen breaks, with the
+        # adjustment ratio of the line each ends.
+        (kinds, widths, stretches, shrinks, penalties, groups) = items
+        line_width = self.line_width
+        tolerance = self.tolerance
+        line_penalty = self.line_penalty
+        fitness_demerits = self.fitness_demerits
+
+        active = [BreakNode(0, 1, 0, 0, 0, 0, 0, None)]
+        total_width = 0
+        total_stretch = 0
+        total_shrink = 0
+        count = len(kinds)
+        for position in range(count):
+            kind = kinds[position]
+            if kind == box:
+                total_width += widths[position]
+                continue
+            if kind == glue:
+                bLegal = position > 0 and kinds[position - 1] == box
+                penalty_value = 0
+                penalty_width = 0
+            else:
+                penalty_value = penalties[position]
+                bLegal = penalty_value < infinity
+                penalty_width = widths[position]
+
+            if bLegal:
+                candidates = [None, None, None, None]
+                survivors = []
+                last_dropped = None
+                for node in active:
+                    length = total_width - node.total_width + penalty_width
+                    if length < line_width:
+                        stretch = total_stretch - node.total_stretch
+                        ratio = (line_width - length) / stretch if stretch > 0 else infinity
+                    elif length > line_width:
+                        shrink = total_shrink - node.total_shrink
+                        ratio = (line_width - length) / shrink if shrink > 0 else -infinity
+                    else:
+                        ratio = 0
+                    if ratio < -1 or penalty_value == -infinity:
+                        last_dropped = (node, ratio)
+                    else:
+                        survivors.append(node)
+                    if -1 <= ratio <= tolerance:
+                        badness = 100 * abs(ratio) ** 3
+                        if penalty_value >= 0:
+                            demerits = (line_penalty + badness) ** 2 + penalty_value ** 2
+                        elif penalty_value > -infinity:
+                            demerits = (line_penalty + badness) ** 2 - penalty_value ** 2
+                        else:
+                            demerits = (line_penalty + badness) ** 2
+                        if ratio < -0.5:
+                            fitness = 0
+                        elif ratio <= 0.5:
+                            fitness = 1
+                        elif ratio <= 1:
+                            fitness = 2
+                        else:
+                            fitness = 3
+                        if abs(fitness - node.fitness) > 1:
+                            demerits += fitness_demerits
+                        demerits += node.demerits
+                        if candidates[fitness] == None or demerits < candidates[fitness][0]:
+                            candidates[fitness] = (demerits, node, ratio)
+
+                if len(survivors) == 0 and candidates == [None, None, None, None] and last_dropped != None:
+                    # No feasible line at all (a group wider than the
+                    # line, say): break here anyway, rather than fail.
+                    (node, ratio) = last_dropped
+                    candidates[0] = (node.demerits + infinity ** 2, node, ratio)
+
+                if candidates != [None, None, None, None]:
+                    # The totals after the break leave out the glue
+                    # and penalties the next line would start with.
+                    after_width = total_width
+                    after_stretch = total_stretch
+                    after_shrink = total_shrink
+                    for index in range(position, count):
+                        if kinds[index] == box:
+                            break
+                        if kinds[index] == glue:
+                            after_width += widths[index]
+                            after_stretch += stretches[index]
+                            after_shrink += shrinks[index]
+                        elif index > position and penalties[index] == -infinity:
+                            break
+                    best = min([candidate[0] for candidate in candidates if candidate != None])
+                    for (fitness, candidate) in enumerate(candidates):
+                        if candidate != None and candidate[0] <= best + fitness_demerits:
+                            (demerits, node, ratio) = candidate
+                            survivors.append(BreakNode(position, fitness, after_width, after_stretch, after_shrink, demerits, ratio, node))
+                active = survivors
+
+            if kind == glue:
+                total_width += widths[position]
+                total_stretch += stretches[position]
+                total_shrink += shrinks[position]
+
+        best = min(active, key=lambda node: node.demerits)
+        breaks = []
+        while best.previous != None:
+            breaks.append((best.position, best.ratio))
+            best = best.previous
+        breaks.reverse()
+        return breaks
+
+    def breakBlockWidths(self, block_widths):
+        # Returns the lines of a block as (first group, last group + 1,
+        # adjustment ratio, whether it starts after a setumah).
+        items = self.getItems(block_widths)
+        groups = items[5]
+        kinds = items[0]
+        lines = []
+        start = 0
+        for (position, ratio) in self.breakItems(items):
+            line_groups = [groups[index] for index in range(start, position) if kinds[index] == box and groups[index] >= 0]
+            bIndented = start > 0 and kinds[start] == box and groups[start] == -1
+            if len(line_groups) != 0:
+                lines.append((line_groups[0], line_groups[-1] + 1, ratio, bIndented))
+            start = position + 1
+            while start < len(kinds) and kinds[start] != box:
+                start += 1
+        return lines
+
+    def getKey(self, block_widths):
+        return hashlib.sha1(repr((self.getParams(), block_widths)).encode('utf-8')).digest()
+
+    def breakBlocks(self, blocks_widths, jobs=1):
+        # Blocks not in the cache are broken on a pool of jobs processes.
+        keys = [self.getKey(block_widths) for block_widths in blocks_widths]
+        missing = []
+        missing_keys = set()
+        for (key, block_widths) in zip(keys, blocks_widths):
+            if key not in self.cache and key not in missing_keys:
+                missing.append((key, block_widths))
+                missing_keys.add(key)
+        if len(missing) != 0:
+            if jobs > 1:
+                pool = multiprocessing.Pool(jobs)
+                try:
+                    results = pool.map(functools.partial(breakBlockWidths, self.getParams()), [block_widths for (key, block_widths) in missing], chunksize=64)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [self.breakBlockWidths(block_widths) for (key, block_widths) in missing]
+            for ((key, block_widths), lines) in zip(missing, results):
+                self.cache[key] = lines
+            self.bCacheChanged = True
+        self.used.update(keys)
+        return [self.cache[key] for key in keys]
+
+    def getCacheFilename(self, cachedir):
+        # One file per width and parameter set, so that a run only ever
+        # reads the breaks it can use.
+        return os.path.join(cachedir, "linebreaks.%s.pickle" % hashlib.sha1(repr(self.getParams()).encode('utf-8')).hexdigest())
+
+    def loadCache(self, filename):
+        if os.path.exists(filename):
+            fin = open(filename, "rb")
+            self.cache.update(pickle.load(fin))
+            fin.close()
+
+    def saveCache(self, filename):
+        # Only the blocks used since loading are kept, so that blocks
+        # which have since changed drop out.  Nothing is written if the
+        # file would not change.
+        if not self.bCacheChanged and len(self.used) == len(self.cache):
+            return
+        with massage_tanakh.atomicOutput(filename) as fout:
+            pickle.dump(dict([(key, self.cache[key]) for key in self.used]), fout, pickle.HIGHEST_PROTOCOL)
+
+
+def breakBlockWidths(params, block_widths):
+    # For the pool: a LineBreaker is rebuilt from its parameters.
+    return LineBreaker(*params).breakBlockWidths(block_widths)
+
+
+########################################
+##
+## Layout
+##
+########################################
+def getLineTexts(block, lines, setumah_text=" " * 9):
+    # The text of each line, in logical (right-to-left) order.
+    group_texts = [text for (paragraph_class, groups) in block for (indexes, text) in groups]
+    paragraph_ends = set()
+    count = 0
+    for (paragraph_class, groups) in block[:-1]:
+        count += len(groups)
+        paragraph_ends.add(count)
+    result = []
+    for (first, last, ratio, bIndented) in lines:
+        parts = []
+        if bIndented:
+            parts.append(setumah_text)
+        for index in range(first, last):
+            if index > first:
+                if index in paragraph_ends:
+                    parts.append(setumah_text)
+                elif not group_texts[index - 1].endswith(maqqef):
+                    parts.append(" ")
+            parts.append(group_texts[index])
+        result.append("".join(parts))
+    return result
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description="Break the paragraphs of the Tanakh into lines of a given width.")
+    argparser.add_argument("-b", "--books", action="append", default=[],
+                           help="books to lay out, as in massage_tanakh.py (default: all)")
+    argparser.add_argument("-i", "--indir", default=default_indir,
+                           help="directory with the UXLC books (default: %(default)s)")
+    argparser.add_argument("-w", "--width", type=float, default=30.0,
+                           help="line width in letters; with --font or --metrics, in alephs (default: %(default)s)")
+    argparser.add_argument("--font",
+                           help="measure with this font file (needs uharfbuzz)")
+    argparser.add_argument("--metrics", nargs="?", const=default_metricsfilename,
+                           help="measure with this plain-Python metric file (default: %s)" % default_metricsfilename)
+    argparser.add_argument("--size", type=float, default=12.0,
+                           help="font size in points, for --font and --metrics (default: %(default)s)")
+    argparser.add_argument("--features", default="",
+                           help="OpenType features for --font, e.g., \"kern,-liga\"")
+    argparser.add_argument("--mode", choices=massage_tanakh.ketivqere_modes, default="qere",
+                           help="which of ketiv and qere to set in the text (default: %(default)s)")
+    argparser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                           help="number of processes to break paragraphs on (default: %(default)s)")
+    argparser.add_argument("--cache-dir", default=default_cachedir,
+                           help="directory for the book and line-break caches (default: %(default)s)")
+    argparser.add_argument("--proof",
+                           help="write the lines, one per line, to this file")
+    args = argparser.parse_args(argv)
+    if len(args.books) == 0:
+        args.books = ["all"]
+
+    booknames = massage_tanakh.selectBooks(args.books, args.indir, False)
+    corpus = massage_tanakh.convertBooks(booknames, args.indir, None, 1, cachedir=args.cache_dir)
+    kq_table = corpus.buildKetivQereTable()
+    blocks = getParagraphBlocks(corpus.objects.get("paragraph", []), corpus.tokens, kq_table.hidden[args.mode])
+
+    # Without a font, everything is in letters; with one, in points,
+    # with an aleph's width standing in for a letter.
+    metrics = None
+    if args.font != None:
+        metrics = GlyphMetrics(HarfBuzzSource(args.font), args.size, parseFeatures(args.features), args.cache_dir)
+    elif args.metrics != None:
+        metrics = GlyphMetrics(MetricFileSource(args.metrics), args.size, parseFeatures(args.features), args.cache_dir)
+    start = time.perf_counter()
+    if metrics == None:
+        unit = 1.0
+        token_widths = getTokenWidths(corpus.tokens)
+    else:
+        unit = metrics.measure("א")
+        token_widths = getTokenWidths(corpus.tokens, metrics.measure)
+        metrics.save()
+        sys.stderr.write("Measured %d new surfaces (of %d distinct) in %.3f s\n" % (metrics.measured, len(corpus.tokens.surfaces.values), time.perf_counter() - start))
+        metrics.close()
+
+    breaker = LineBreaker(args.width * unit, space=0.5 * unit, stretch=0.25 * unit, shrink=0.15 * unit, setumah=9.0 * unit)
+    cachefilename = breaker.getCacheFilename(args.cache_dir)
+    breaker.loadCache(cachefilename)
+    start = time.perf_counter()
+    all_lines = breaker.breakBlocks([getBlockWidths(block, token_widths) for block in blocks], args.jobs)
+    elapsed = time.perf_counter() - start
+    breaker.saveCache(cachefilename)
+
+    line_count = sum([len(lines) for lines in all_lines])
+    sys.stderr.write("%d blocks, %d lines at width %g in %.3f s\n" % (len(blocks), line_count, args.width, elapsed))
+
+    if args.proof != None:
+        fout = open(args.proof, "w", encoding="utf-8")
+        for (block, lines) in zip(blocks, all_lines):
+            for text in getLineTexts(block, lines):
+                fout.write(text + "\n")
+            fout.write("\n")
+        fout.close()
+
+
+if __name__ == "__main__":
+    main()
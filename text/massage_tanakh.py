@@ -1,9 +1,32 @@
 # -*- coding: utf-8 -*-
 import xml.sax
+import xml.parsers.expat
 import codecs
+import io
 import sys
 import os
 import re
+import functools
+import multiprocessing
+import tempfile
+import shutil
+import array
+import hashlib
+import pickle
+import argparse
+import time
+import json
+import struct
+import bisect
+import itertools
+import asyncio
+import concurrent.futures
+import contextlib
+
+try:
+    import lxml.etree as lxml_etree
+except ImportError:
+    lxml_etree = None
 
 tag_re = re.compile(r'<[^>]+>')
 
@@ -49,29 +72,34 @@ special_dict = {
     '\\' : '\\\\',
 }
 
-upper_bit_re = re.compile(rb'[\x80-\xff]')
-
-def special_sub(mo):
-    c = mo.group(0)
-    assert len(c) == 1
-    return special_dict[c]
+class MQLCharTable(dict):
+    # A str.translate() table from code point to its MQL form: the
+    # specials are backslash-escaped, the rest of ASCII is left alone,
+    # and anything else becomes the \xNN escapes of its UTF-8 bytes.
+    # Entries are made the first time a code point is seen.
+    def __missing__(self, codepoint):
+        c = chr(codepoint)
+        if c in special_dict:
+            result = special_dict[c]
+        elif codepoint < 0x80:
+            result = c
+        else:
+            result = "".join(["\\x%02x" % b for b in c.encode('utf-8')])
+        self[codepoint] = result
+        return result
 
-def upper_bit_sub(mo):
-    c = mo.group(0)
-    assert type(c) == type(b"a")
-    assert len(c) == 1
-    return b"\\x%02x" % ord(c)
+mql_char_table = MQLCharTable()
 
+# Surfaces, morph codes and osisBooks repeat a lot, so most calls are
+# answered from the cache.
+@functools.lru_cache(maxsize=65536)
 def mangleMQLString(ustr):
-    result = special_re.sub(special_sub, ustr)
-    #print("UP200: ustr = '%s' result = %s, repr(result.encode('utf-8')) = %s, type(result) = %s type(result.encode('utf-8')) = %s" % (ustr, result, repr(result.encode('utf-8')), type(result), type(result.encode('utf-8'))))
-    result = upper_bit_re.sub(upper_bit_sub, result.encode('utf-8'))
-    result = result.decode('utf-8')
-    return result
+    return ustr.translate(mql_char_table)
 
     
     
 
+# Chained replaces beat both str.translate and an lru_cache here.
 def mangle_XML_entities(s):
     r = s.replace("&", "&amp;")
     r = r.replace("<", "&lt;")
@@ -79,33 +107,210 @@ def mangle_XML_entities(s):
     r = r.replace("\"", "&quot;")
     return r
 
+language_names = {
+    "H" : "Hebrew",
+    "A" : "Aramaic",
+}
+
+########################################
+##
+## Surface variants
+##
+########################################
+#
+# Besides the surface as it is (accented), each token has a pointed
+# form, without the accents, and a consonantal form, with only the
+# letters.  Each Hebrew codepoint UXLC uses is in one of these classes;
+# anything else is kept in every form.
+surface_codepoint_classes = {}
+for codepoint in range(0x05d0, 0x05eb):
+    surface_codepoint_classes[codepoint] = "letter"
+for codepoint in list(range(0x05b0, 0x05bd)) + [0x05bf, 0x05c1, 0x05c2, 0x05c7]:
+    surface_codepoint_classes[codepoint] = "point"
+# Meteg, paseq and the puncta extraordinaria go with the accents.
+for codepoint in list(range(0x0591, 0x05b0)) + [0x05bd, 0x05c0, 0x05c4, 0x05c5]:
+    surface_codepoint_classes[codepoint] = "accent"
+for codepoint in [0x05be, 0x05c3, 0x05c6]:
+    surface_codepoint_classes[codepoint] = "punctuation"
+# CGJ keeps two points in order, so only the consonantal form loses it.
+for codepoint in [0x034f, 0x200d]:
+    surface_codepoint_classes[codepoint] = "joiner"
+
+pointed_table = dict([(codepoint, None) for codepoint in surface_codepoint_classes if surface_codepoint_classes[codepoint] == "accent"])
+consonantal_table = dict([(codepoint, None) for codepoint in surface_codepoint_classes if surface_codepoint_classes[codepoint] != "letter"])
+
+# Only for tokens on their own (Token, and the streaming path): a small
+# cache is enough for the most frequent word forms.  TokenStore works
+# out the variants once per distinct surface anyway.
+@functools.lru_cache(maxsize=4096)
+def getSurfaceVariants(surface):
+    # (pointed, consonantal)
+    return (surface.translate(pointed_table), surface.translate(consonantal_table))
+
+
+token_mql_format = "CREATE OBJECT FROM MONADS={%d}\n[surface:=\"%s\";pointed:=\"%s\";consonantal:=\"%s\";\nlanguage:=%s;docindex:=%d;word_id:=\"%s\";word_type:=\"%s\";word_n:=\"%s\";morph:=\"%s\";strongs:=\"%s\";]"
+
 class Token:
+    __slots__ = ["monad", "surface", "morph", "strongs", "language", "word_id", "word_type", "word_n", "docindex"]
+
     def __init__(self, monad, surface, morph, strongs, word_id, word_type, word_n, language, docindex):
         self.monad = monad
         self.surface = surface
         self.morph = morph
         self.strongs = strongs
-        if language == "H":
-            self.language = "Hebrew"
-        elif language == "A":
-            self.language = "Aramaic"
+        if language in language_names:
+            self.language = language_names[language]
         else:
             raise Exception("Unknown token language: %s" % language)
         self.word_id = word_id
         self.word_type = word_type
         self.word_n = word_n
         self.docindex = docindex
-        
+
+    pointed = property(lambda self: getSurfaceVariants(self.surface)[0])
+    consonantal = property(lambda self: getSurfaceVariants(self.surface)[1])
+
+    def renderMQL(self):
+        (pointed, consonantal) = getSurfaceVariants(self.surface)
+        return token_mql_format % (self.monad, mangleMQLString(self.surface), mangleMQLString(pointed), mangleMQLString(consonantal), self.language, self.docindex, self.word_id, self.word_type, self.word_n, self.morph, self.strongs)
+
     def dumpMQL(self, f):
-        f.write(("CREATE OBJECT FROM MONADS={%d}\n" % self.monad).encode('utf-8'))
-        f.write(("[surface:=\"%s\";\n" % (mangleMQLString(self.surface))).encode('utf-8'))
-        f.write(("language:=%s;" % self.language).encode('utf-8'))
-        f.write(("docindex:=%d;" % self.docindex).encode('utf-8'))
-        f.write(("word_id:=\"%s\";" % self.word_id).encode('utf-8'))
-        f.write(("word_type:=\"%s\";" % self.word_type).encode('utf-8'))
-        f.write(("word_n:=\"%s\";" % self.word_n).encode('utf-8'))
-        f.write(("morph:=\"%s\";" % self.morph).encode('utf-8'))
-        f.write(("strongs:=\"%s\";]" % self.strongs).encode('utf-8'))
+        f.write(self.renderMQL().encode('utf-8'))
+
+
+########################################
+##
+## Columnar token store
+##
+########################################
+class StringColumn:
+    # A column of strings, each stored as a code into the table of
+    # distinct values seen so far.
+    def __init__(self):
+        self.codes = array.array('i')
+        self.values = []
+        self.value2code = {}
+
+    def encode(self, value):
+        code = self.value2code.get(value)
+        if code == None:
+            code = len(self.values)
+            self.values.append(value)
+            self.value2code[value] = code
+        return code
+
+    def append(self, value):
+        code = self.value2code.get(value)
+        if code == None:
+            code = self.encode(value)
+        self.codes.append(code)
+
+    def extend(self, other):
+        recode = [self.encode(value) for value in other.values]
+        self.codes.extend([recode[code] for code in other.codes])
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class TokenStore:
+    # The tokens of a book or a corpus as parallel columns.  Indexing or
+    # iterating gives Token objects, built on the fly.
+    def __init__(self):
+        self.monads = array.array('i')
+        self.docindexes = array.array('i')
+        self.surfaces = StringColumn()
+        self.morphs = StringColumn()
+        self.strongs = StringColumn()
+        self.word_ids = StringColumn()
+        self.word_types = StringColumn()
+        self.word_ns = StringColumn()
+        self.languages = StringColumn()
+
+        # Filled in by computeVariants(), with, per surface code, the
+        # codes of its pointed and consonantal forms.
+        self.pointeds = StringColumn()
+        self.consonantals = StringColumn()
+        self.surface_pointed_codes = array.array('i')
+        self.surface_consonantal_codes = array.array('i')
+
+    def append(self, monad, surface, morph, strongs, word_id, word_type, word_n, language, docindex):
+        if language not in language_names:
+            raise Exception("Unknown token language: %s" % language)
+        self.monads.append(monad)
+        self.docindexes.append(docindex)
+        self.surfaces.append(surface)
+        self.morphs.append(morph)
+        self.strongs.append(strongs)
+        self.word_ids.append(word_id)
+        self.word_types.append(word_type)
+        self.word_ns.append(word_n)
+        self.languages.append(language)
+
+    def extend(self, other):
+        if len(self.pointeds) == len(self) and len(other.pointeds) == len(other):
+            self.pointeds.extend(other.pointeds)
+            self.consonantals.extend(other.consonantals)
+        self.monads.extend(other.monads)
+        self.docindexes.extend(other.docindexes)
+        self.surfaces.extend(other.surfaces)
+        self.morphs.extend(other.morphs)
+        self.strongs.extend(other.strongs)
+        self.word_ids.extend(other.word_ids)
+        self.word_types.extend(other.word_types)
+        self.word_ns.extend(other.word_ns)
+        self.languages.extend(other.languages)
+
+    def computeVariants(self):
+        # The pointed and consonantal forms of the tokens added since
+        # the last call, worked out once per distinct surface.
+        start = len(self.pointeds)
+        if start == len(self.monads):
+            return
+        pointed_codes = self.surface_pointed_codes
+        consonantal_codes = self.surface_consonantal_codes
+        for surface in self.surfaces.values[len(pointed_codes):]:
+            pointed = surface.translate(pointed_table)
+            consonantal = surface.translate(consonantal_table)
+            pointed_codes.append(self.pointeds.encode(pointed))
+            consonantal_codes.append(self.consonantals.encode(consonantal))
+        codes = self.surfaces.codes[start:]
+        self.pointeds.codes.extend([pointed_codes[code] for code in codes])
+        self.consonantals.codes.extend([consonantal_codes[code] for code in codes])
+
+    def rebaseMonads(self, offset):
+        self.monads = array.array('i', [monad + offset for monad in self.monads])
+
+    def __len__(self):
+        return len(self.monads)
+
+    def __getitem__(self, index):
+        return Token(self.monads[index], self.surfaces[index], self.morphs[index], self.strongs[index], self.word_ids[index], self.word_types[index], self.word_ns[index], self.languages[index], self.docindexes[index])
+
+    def __iter__(self):
+        for index in range(len(self.monads)):
+            yield self[index]
+
+    def iterMQL(self):
+        # Same as Token.renderMQL(), straight from the columns.
+        self.computeVariants()
+        monads = self.monads
+        docindexes = self.docindexes
+        surfaces = self.surfaces
+        morphs = self.morphs
+        strongs = self.strongs
+        word_ids = self.word_ids
+        word_types = self.word_types
+        word_ns = self.word_ns
+        languages = self.languages
+        pointeds = self.pointeds
+        consonantals = self.consonantals
+        for index in range(len(monads)):
+            yield token_mql_format % (monads[index], mangleMQLString(surfaces[index]), mangleMQLString(pointeds[index]), mangleMQLString(consonantals[index]), language_names[languages[index]], docindexes[index], word_ids[index], word_types[index], word_ns[index], morphs[index], strongs[index])
+
 
 class NonBibleToken:
     def __init__(self, monad, surface, docindex):
@@ -113,9 +318,11 @@ class NonBibleToken:
         self.wholesurface = surface
         self.docindex = docindex
 
+    def renderMQL(self):
+        return "CREATE OBJECT FROM MONADS={%d}\n[wholesurface:=\"%s\";docindex:=%d;]\n" % (self.monad, mangleMQLString(self.wholesurface), self.docindex)
+
     def dumpMQL(self, f):
-        f.write(b"CREATE OBJECT FROM MONADS={%d}\n" % self.monad)
-        f.write(("[wholesurface:=\"%s\";docindex:=%d;]\n" % (mangleMQLString(self.wholesurface), self.docindex)).encode('utf-8'))
+        f.write(self.renderMQL().encode('utf-8'))
 
 class NonWordBibleToken:
     def __init__(self, monad, surface, docindex):
@@ -123,31 +330,139 @@ class NonWordBibleToken:
         self.wholesurface = surface
         self.docindex = docindex
 
+    def renderMQL(self):
+        return "CREATE OBJECT FROM MONADS={%d}\n[wholesurface:=\"%s\";docindex:=%d;]\n" % (self.monad, mangleMQLString(self.wholesurface), self.docindex)
+
     def dumpMQL(self, f):
-        f.write(b"CREATE OBJECT FROM MONADS={%d}\n" % self.monad)
-        f.write(("[wholesurface:=\"%s\";docindex:=%d;]\n" % (mangleMQLString(self.wholesurface), self.docindex)).encode('utf-8'))
+        f.write(self.renderMQL().encode('utf-8'))
+
+
+class SRObjectSchema:
+    # The features of one object type, in the order in which they were
+    # first set, with whether each is a string feature.  Per feature, it
+    # also interns the values, so that, e.g., all the verses of a book
+    # share one osisBook string, and caches each value's rendered MQL.
+    # Only the first cache_limit values of a feature are kept, so that
+    # features with a value per object (osisID, docindex, ...) do not
+    # fill the caches with values that never come round again.
+    cache_limit = 256
+
+    def __init__(self, objectTypeName):
+        self.objectTypeName = objectTypeName
+        self.names = []
+        self.bIsString = []
+        self.slots = {}
+        self.resetCaches()
+
+    def resetCaches(self):
+        self.interned = [{} for name in self.names]
+        self.rendered = [{} for name in self.names]
+        # Non-string features render before string features.
+        self.render_order = [slot for slot in range(len(self.names)) if not self.bIsString[slot]] + [slot for slot in range(len(self.names)) if self.bIsString[slot]]
+
+    def __getstate__(self):
+        # The caches are cheap to refill and would only bloat the pickles.
+        return (self.objectTypeName, self.names, self.bIsString)
+
+    def __setstate__(self, state):
+        (self.objectTypeName, self.names, self.bIsString) = state
+        self.slots = dict([(name, slot) for (slot, name) in enumerate(self.names)])
+        self.resetCaches()
+
+    def getSlot(self, name, bIsString):
+        slot = self.slots.get(name)
+        if slot == None:
+            slot = len(self.names)
+            self.names.append(name)
+            self.bIsString.append(bIsString)
+            self.slots[name] = slot
+            self.resetCaches()
+        elif self.bIsString[slot] != bIsString:
+            raise Exception("ERROR: Feature %s.%s set both as a string and as a non-string." % (self.objectTypeName, name))
+        return slot
+
+    def intern(self, slot, value):
+        interned = self.interned[slot]
+        result = interned.get(value)
+        if result == None:
+            result = value
+            if len(interned) < self.cache_limit:
+                interned[value] = value
+        return result
+
+    def render(self, slot, value):
+        rendered = self.rendered[slot]
+        mql = rendered.get(value)
+        if mql == None:
+            if self.bIsString[slot]:
+                mql = "  %s:=\"%s\";" % (self.names[slot], mangleMQLString(value))
+            else:
+                mql = "  %s:=%s;\n" % (self.names[slot], value)
+            if len(rendered) < self.cache_limit:
+                rendered[value] = mql
+        return mql
+
+
+sr_object_schemas = {}
+
+def getSRObjectSchema(objectTypeName):
+    schema = sr_object_schemas.get(objectTypeName)
+    if schema == None:
+        schema = SRObjectSchema(objectTypeName)
+        sr_object_schemas[objectTypeName] = schema
+    return schema
 
 
 class SRObject:
+    # Feature values sit in a list, in the slots their SRObjectSchema
+    # gives them; None is a feature that is not set.
+    __slots__ = ["objectTypeName", "schema", "fm", "lm", "id_d", "values"]
+
     def __init__(self, objectTypeName, starting_monad):
         self.objectTypeName = objectTypeName
+        self.schema = getSRObjectSchema(objectTypeName)
         self.fm = starting_monad
         self.lm = starting_monad
-        self.stringFeatures = {}
-        self.nonStringFeatures = {}
         self.id_d = 0
+        self.values = []
 
     def setID_D(self, id_d):
         self.id_d = id_d
 
+    def setFeature(self, name, value, bIsString):
+        slot = self.schema.getSlot(name, bIsString)
+        if slot >= len(self.values):
+            self.values.extend([None] * (slot + 1 - len(self.values)))
+        self.values[slot] = self.schema.intern(slot, value)
+
     def setStringFeature(self, name, value):
-        self.stringFeatures[name] = value
+        self.setFeature(name, value, True)
 
     def setNonStringFeature(self, name, value):
-        self.nonStringFeatures[name] = value
+        self.setFeature(name, value, False)
+
+    def getFeature(self, name):
+        slot = self.schema.slots.get(name)
+        if slot == None or slot >= len(self.values):
+            return None
+        return self.values[slot]
 
     def getStringFeature(self, name):
-        return self.stringFeatures[name]
+        value = self.getFeature(name)
+        if value == None:
+            raise KeyError(name)
+        return value
+
+    def getFeatures(self, bIsString):
+        result = {}
+        for (slot, value) in enumerate(self.values):
+            if value != None and self.schema.bIsString[slot] == bIsString:
+                result[self.schema.names[slot]] = value
+        return result
+
+    # As dicts, for reading only.
+    stringFeatures = property(lambda self: self.getFeatures(True))
+    nonStringFeatures = property(lambda self: self.getFeatures(False))
 
     def setLastMonad(self, ending_monad):
         if ending_monad < self.fm:
@@ -155,23 +470,45 @@ class SRObject:
         else:
             self.lm = ending_monad
 
-    def dumpMQL(self, fout):
-        fout.write(("CREATE OBJECT FROM MONADS={%d-%d}" % (self.fm, self.lm)).encode('utf-8'))
+    def renderMQL(self):
         if self.id_d != 0:
-            fout.write(("WITH ID_D=%d" % self.id_d).encode('utf-8'))
-        fout.write(b"[")
-        for key in self.nonStringFeatures:
-            value = self.nonStringFeatures[key]
-            fout.write(("  %s:=%s;\n" % (key, value)).encode('utf-8'))
-        for key in self.stringFeatures:
-            value = self.stringFeatures[key]
-            fout.write(("  %s:=\"%s\";" % (key, mangleMQLString(value))).encode('utf-8'))
-        fout.write(b"]\n")
+            parts = ["CREATE OBJECT FROM MONADS={%d-%d}WITH ID_D=%d[" % (self.fm, self.lm, self.id_d)]
+        else:
+            parts = ["CREATE OBJECT FROM MONADS={%d-%d}[" % (self.fm, self.lm)]
+        values = self.values
+        count = len(values)
+        schema = self.schema
+        rendered = schema.rendered
+        for slot in schema.render_order:
+            if slot < count:
+                value = values[slot]
+                if value != None:
+                    mql = rendered[slot].get(value)
+                    if mql == None:
+                        mql = schema.render(slot, value)
+                    parts.append(mql)
+        parts.append("]\n")
+        return "".join(parts)
+
+    def dumpMQL(self, fout):
+        fout.write(self.renderMQL().encode('utf-8'))
 
 
 class TanakhHandler(xml.sax.ContentHandler):
-    def __init__(self, bookname):
+    def __init__(self, bookname, first_monad=1, spooler=None, aligner=None):
         self.bookname = bookname
+        self.first_monad = first_monad
+
+        # If we have a MorphhbAligner, words get morph, strongs and
+        # language from it.
+        self.aligner = aligner
+
+        # If we have a spooler, objects and tokens go straight to it
+        # as they close, instead of being kept in self.objects etc.
+        self.spooler = spooler
+
+        # Only InstrumentedTanakhHandler keeps statistics.
+        self.stats = None
         
         self.elemstack = []
         self.charstack = []
@@ -186,23 +523,59 @@ class TanakhHandler(xml.sax.ContentHandler):
         self.bInCatchWord = False
         self.bInSeg = False
 
+        # The massaged XML.  With an xmlwriter, it is handed on to it
+        # as each verse closes; without, it is kept for getXML().
         self.outlist = []
+        self.xmlwriter = None
 
-        self.nixed_elements = set(["teiHeader", "notes", "vs", "cs"])
-        self.ignored_elements = set(["tanach", "book"])
+        self.curmonad = first_monad
+        self.curdocindex = 1
+
+        self.objects = {}
+        self.curobjects = {}
+        self.tokens = TokenStore()
+        self.non_bible_tokens = []
+
+        self.curBook = None
+        self.curosisBook = ""
+        self.curChapter = None
+        self.curVerse = None
+        self.curosisChapter = ""
+
+        # The ketiv and qere words, as (monad, surface), of the kq
+        # object being built.
+        self.kq_ketiv = []
+        self.kq_qere = []
+
+        self.paragraph_first_monad = -1
+        self.paragraph_docindex = -1
+
+        self.curstrongs = ""
+        self.curmorph = ""
+        self.curlanguage = "H"
+        self.cur_word_id = ""
+        self.cur_word_type = ""
+        self.cur_word_n = ""
+        self.wordcharstack = []
+
+        self.booknames = {}
 
         self.nixing_stack = []
-        self.single_tag_elements = {
-            #"br" : None
-        }
-        self.handled_elements = set(["names", "name", "abbrev", "number", "filename", "hebrewname", "c", "v", "w"])
+        self.note_type = ""
 
         
     def startDocument(self):
         pass
 
     def endDocument(self):
-        pass
+        self.endVerse()
+        self.endChapter()
+        self.endParagraph("end")
+        self.endBook()
+        if self.aligner != None:
+            self.aligner.endBook()
+        self.flushXML()
+        self.tokens.computeVariants()
 
     def characters(self, data):
         self.charstack.append(data)
@@ -234,7 +607,11 @@ class TanakhHandler(xml.sax.ContentHandler):
         if len(chars) == 0:
             return
 
-        if whitespace_re.match(chars):
+        if self.bInW:
+            # The text of a <w>, <k> or <q> can be split up by <x> and
+            # <s> children, so we collect it until the word closes.
+            self.wordcharstack.append(chars)
+        elif whitespace_re.match(chars):
             # The whole string consists solely of whitespace.
             # We ignore this string because we have a different way of
             # knowing when to add whitespace.
@@ -250,8 +627,8 @@ class TanakhHandler(xml.sax.ContentHandler):
         else:
             assert bIsEndTag
 
-            if tag == "w":
-                self.addWordTokens(chars)
+            if tag in self.name_elements:
+                self.booknames[tag] = chars.strip()
             else:
                 assert False, "ERROR: Don't know how to handeChars(chars_before = '%s', tag = '%s', bIsEndTag = %s)." % (chars_before, tag, bIsEndTag)
 
@@ -277,207 +654,337 @@ class TanakhHandler(xml.sax.ContentHandler):
         return morph[0] == 'R'
 
     def addWordTokens(self, chars):
-        pass
+        for (prefix, surface, suffix) in self.tokenize_on_whitespace(chars):
+            if surface == "":
+                continue
+
+            self.startParagraphIfNotStarted()
+
+            morph = self.curmorph
+            strongs = self.curstrongs
+            language = self.curlanguage
+            if self.aligner != None:
+                aligned = self.aligner.alignWord(surface, self.cur_word_type)
+                if aligned != None:
+                    (morph, strongs, language) = aligned
+
+            self.addToken(self.curmonad, surface, morph, strongs, self.cur_word_id, self.cur_word_type, self.cur_word_n, language, self.curdocindex)
+
+            if self.cur_word_type == "x-ketiv":
+                # A ketiv after a qere starts the next pair.
+                if len(self.kq_qere) != 0:
+                    self.endKQ()
+                self.kq_ketiv.append((self.curmonad, surface))
+            elif self.cur_word_type == "x-qere":
+                self.kq_qere.append((self.curmonad, surface))
+            else:
+                self.endKQ()
+
+            if self.cur_word_type != "":
+                self.outlist.append("<w type=\"%s\">%s</w>\n" % (self.cur_word_type, mangle_XML_entities(surface)))
+            else:
+                self.outlist.append("<w>%s</w>\n" % mangle_XML_entities(surface))
+
+            self.curmonad += 1
+            self.curdocindex += 1
+
+    def createObject(self, objectTypeName):
+        obj = SRObject(objectTypeName, self.curmonad)
+        obj.setNonStringFeature("docindex", self.curdocindex)
+        self.curdocindex += 1
+        self.curobjects[objectTypeName] = obj
+        return obj
+
+    def endObject(self, objectTypeName):
+        obj = self.curobjects.pop(objectTypeName)
+        obj.setLastMonad(self.curmonad-1)
+        self.addObject(obj)
+
+    def addObject(self, obj):
+        if self.spooler != None:
+            self.spooler.addObject(obj)
+        else:
+            self.objects.setdefault(obj.objectTypeName, []).append(obj)
+
+    def addToken(self, monad, surface, morph, strongs, word_id, word_type, word_n, language, docindex):
+        if self.spooler != None:
+            self.spooler.addToken(Token(monad, surface, morph, strongs, word_id, word_type, word_n, language, docindex))
+        else:
+            self.tokens.append(monad, surface, morph, strongs, word_id, word_type, word_n, language, docindex)
+
+    def addCurMonadToObjects(self):
+        for obj in self.curobjects.values():
+            obj.setLastMonad(self.curmonad)
 
 
     def startElement(self, tag, attributes):
         self.elemstack.append(tag)
 
-        chars = "".join(self.charstack)
-        del self.charstack
-        self.charstack = []
+        # With expat's buffered text there is usually at most one piece.
+        if len(self.charstack) == 0:
+            chars = ""
+        else:
+            chars = "".join(self.charstack)
+            self.charstack = []
 
         self.handleChars(chars, tag, False)
 
-        if tag in self.nixed_elements:
-            self.nixing_stack.append(tag)
-        elif len(self.nixing_stack) != 0:
-            pass
-        elif tag in self.simple_SR_elements:
-            objectTypeName = self.tag2objectTypeName[tag]
-            self.createObject(objectTypeName) 
-        elif tag in self.handled_elements:
-            self.handleElementStart(tag, attributes)
-        elif tag in self.ignored_elements:
-            pass
-        else:
+        if len(self.nixing_stack) != 0:
+            if tag in self.nixed_elements:
+                self.nixing_stack.append(tag)
+            return
+
+        handlers = self.tag_handlers.get(tag)
+        if handlers == None:
             raise Exception(("Error: Unknown start-tag '<" + tag + ">'").encode('utf-8'))
+        handlers[0](self, tag, attributes)
+
+    # Each tag maps to a (start, end) pair of these in tag_handlers,
+    # which buildTagHandlers fills in once, from the tables below.
+    # The tags from OSHB's OSIS (seg, div, verse, note, ...) never occur
+    # in UXLC, but are kept for morphhb-style input.
+
+    nixed_elements = set(["teiHeader", "notes", "vs", "cs", "x", "marking"])
+    ignored_elements = set(["Tanach", "tanach", "book", "s", "reversednun"])
+    single_tag_elements = {
+        #"br" : None
+    }
+    simple_SR_elements = set()
+    tag2objectTypeName = {
+        "catchWord" : "catchWord",
+        "rdg" : "rdg",
+    }
+
+    # The word elements, and the word type each implies.
+    word_elements = {
+        "w" : "",
+        "k" : "x-ketiv",
+        "q" : "x-qere",
+    }
+    name_elements = set(["name", "abbrev", "number", "filename", "hebrewname"])
+
+    # The paragraph-breaking elements, and the class they give the
+    # paragraph they end.
+    paragraph_elements = {
+        "pe" : "pe",
+        "samekh" : "samekh",
+    }
+
+    # seg@type: (bAddToCurrent, bAddSpaceToCurrent) at the start and at
+    # the end of the seg, and the class of the paragraph it ends, if any.
+    seg_types = {
+        "x-maqqef" : ((True, False), (True, False), None),
+        "x-sof-pasuq" : ((True, True), (False, False), None),
+        "x-pe" : ((False, False), (False, False), "pe"),
+        "x-samekh" : ((False, False), (False, False), "samekh"),
+        "x-paseq" : ((False, False), (False, False), None),
+        "x-suspended" : ((False, False), (False, False), None),
+        "x-large" : ((False, False), (False, False), None),
+        "x-reversednun" : ((False, False), (False, False), None),
+        "x-small" : ((False, False), (False, False), None),
+    }
+
+    # div@type: what a title inside such a div is a title of.
+    div_types = {
+        "bookGroup" : "bookGroup",
+        "book" : "book",
+    }
+
+    def startNixed(self, tag, attributes):
+        self.nixing_stack.append(tag)
+
+    def endNixed(self, tag):
+        oldTag = self.nixing_stack.pop()
+        assert tag == oldTag
+
+    def startNothing(self, tag, attributes):
+        pass
 
-    def handleElementStart(self, tag, attributes):
-        if tag == "w":
-            if "lemma" in attributes:
-                lemma = attributes["lemma"]
-                #if lemma == "?":
-                #    lemma = ""
-            else:
-                lemma = ""
-            arr = [s.strip() for s in lemma.split("/")]
-            self.curstrongs = "/".join(arr)
+    def endNothing(self, tag):
+        pass
 
-            if "morph" in attributes:
-                morph = attributes["morph"]
+    def startSimpleSR(self, tag, attributes):
+        self.createObject(self.tag2objectTypeName[tag])
 
-                # Split off the initial language.
-                self.curlanguage = morph[0]
+    def endSimpleSR(self, tag):
+        self.endObject(self.tag2objectTypeName[tag])
 
-                assert self.curlanguage in set(["H", "A"])
-                
-                real_tags = morph[1:]
-            else:
-                real_tags = ""
+    def startWord(self, tag, attributes):
+        if "lemma" in attributes:
+            lemma = attributes["lemma"]
+            #if lemma == "?":
+            #    lemma = ""
+        else:
+            lemma = ""
+        arr = [s.strip() for s in lemma.split("/")]
+        self.curstrongs = "/".join(arr)
 
-            self.curmorph = real_tags
+        if "morph" in attributes:
+            morph = attributes["morph"]
 
-            if "id" in attributes:
-                self.cur_word_id = attributes["id"]
-            else:
-                self.cur_word_id = ""
+            # Split off the initial language.
+            self.curlanguage = morph[0]
 
-            if "type" in attributes:
-                self.cur_word_type = attributes["type"]
-                assert self.cur_word_type in set(["x-ketiv"]), "ERROR: Unknown word@type = '%s'" % self.cur_word_type
-            else:
-                self.cur_word_type = ""
+            assert self.curlanguage in set(["H", "A"])
+            
+            real_tags = morph[1:]
+        else:
+            # UXLC carries no morphology, hence no language either.
+            self.curlanguage = "H"
+            real_tags = ""
 
-            if "n" in attributes:
-                self.cur_word_n = attributes["n"]
-            else:
-                self.cur_word_n = ""
+        self.curmorph = real_tags
 
-            self.bInW = True
-        elif tag == "seg":
-            self.bInSeg = True
-            self.seg_type = attributes["type"]
+        if "id" in attributes:
+            self.cur_word_id = attributes["id"]
+        else:
+            self.cur_word_id = ""
 
-            #print(self.seg_type)
-            assert self.seg_type in ["x-sof-pasuq", "x-maqqef", "x-paseq", "x-pe", "x-samekh", "x-large", "x-reversednun", "x-suspended", "x-small"]
+        if "type" in attributes:
+            self.cur_word_type = attributes["type"]
+            assert self.cur_word_type in set(["x-ketiv", "x-qere"]), "ERROR: Unknown word@type = '%s'" % self.cur_word_type
+        else:
+            self.cur_word_type = self.word_elements[tag]
 
-            penultimate_tag = self.elemstack[-2]
+        if "n" in attributes:
+            self.cur_word_n = attributes["n"]
+        else:
+            self.cur_word_n = ""
 
-            if penultimate_tag not in set(["verse"]):
-                sys.stderr.write("UP230: <seg type=\"%s\">... occurs with surprising parent tag: <%s>\n" % (self.seg_type, penultimate_tag))
-            
-            if self.seg_type == "x-maqqef":
-                self.bAddToCurrent = True
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-sof-pasuq":
-                self.bAddToCurrent = True
-                self.bAddSpaceToCurrent = True
-            elif self.seg_type == "x-pe":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-paseq":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-samekh":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-suspended":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-large":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-reversednun":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-small":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-            else:
-                assert False, "Unknown sef_type: '%s'" % self.seg_type
-        elif tag == "v":
-            self.endVerse()
-            self.startVerse(attributes["v"])
-        elif tag == "chapter":
+        self.bInW = True
+
+    def endWord(self, tag):
+        self.addWordTokens("".join(self.wordcharstack))
+        self.wordcharstack = []
+        self.curstrongs = ""
+        self.curmorph = ""
+        self.cur_word_id = ""
+        self.cur_word_type = ""
+        self.cur_word_n = ""
+        self.bInW = False
+        self.bAddToCurrent = False
+        self.bAddSpaceToCurrent = False
+
+    def startSeg(self, tag, attributes):
+        self.bInSeg = True
+        self.seg_type = attributes["type"]
+
+        assert self.seg_type in self.seg_types, "Unknown seg_type: '%s'" % self.seg_type
+
+        penultimate_tag = self.elemstack[-2]
+
+        if penultimate_tag not in set(["verse"]):
+            sys.stderr.write("UP230: <seg type=\"%s\">... occurs with surprising parent tag: <%s>\n" % (self.seg_type, penultimate_tag))
+
+        (self.bAddToCurrent, self.bAddSpaceToCurrent) = self.seg_types[self.seg_type][0]
+
+    def endSeg(self, tag):
+        self.bInSeg = False
+        (start_flags, end_flags, paragraph_class) = self.seg_types[self.seg_type]
+        (self.bAddToCurrent, self.bAddSpaceToCurrent) = end_flags
+        if paragraph_class != None:
+            self.endParagraph(paragraph_class)
+            self.startParagraph()
+
+    def startV(self, tag, attributes):
+        self.endVerse()
+        self.startVerse("%s.%s" % (self.curosisChapter, attributes["n"]))
+
+    def startC(self, tag, attributes):
+        self.endVerse()
+        self.endChapter()
+        self.startChapter("%s.%s" % (self.curosisBook, attributes["n"]))
+
+    def startNames(self, tag, attributes):
+        self.booknames = {}
+
+    def endNames(self, tag):
+        self.endBook()
+        self.startBook(filename2osisBook[self.booknames["filename"]])
+
+    def startParagraphElement(self, tag, attributes):
+        self.endParagraph(self.paragraph_elements[tag])
+        self.startParagraph()
+        self.outlist.append("<%s/>\n" % tag)
+
+    def startOSISChapter(self, tag, attributes):
+        self.endVerse()
+        self.endChapter()
+        self.startChapter(attributes["n"])
+
+    def endOSISVerse(self, tag):
+        self.endVerse()
+
+    def startTitle(self, tag, attributes):
+        divtype = self.div_types.get(self.divtypestack[-1])
+        if divtype == "book" and self.bInChapter:
+            divtype = "chapter"
+        if divtype != None:
+            obj = self.createObject("title")
+            obj.setNonStringFeature("divtype", divtype)
+
+    def endTitle(self, tag):
+        if self.divtypestack[-1] in self.div_types:
+            self.endObject("title")
+
+    def startDiv(self, tag, attributes):
+        self.divtypestack.append(attributes["type"])
+        if self.divtypestack[-1] == "book":
             self.endVerse()
             self.endChapter()
-            self.startChapter(attributes["n"])
-        elif tag == "title":
-            if self.divtypestack[-1] == "bookGroup":
-                obj = self.createObject("title")
-                obj.setNonStringFeature("divtype", "bookGroup")
-            elif self.divtypestack[-1] == "book":
-                if self.bInChapter:
-                    obj = self.createObject("title")
-                    obj.setNonStringFeature("divtype", "chapter")
-                else:
-                    obj = self.createObject("title")
-                    obj.setNonStringFeature("divtype", "book")
-        elif tag == "div":
-            self.divtypestack.append(attributes["type"])
-            if self.divtypestack[-1] == "bookGroup":
-                pass
-            elif self.divtypestack[-1] == "book":
-                self.endVerse()
-                self.endChapter()
-                self.endBook()
-                self.startBook(attributes["osisID"])
-
-    def handleElementEnd(self, tag):
-        if tag == "w":
-            self.curstrongs = ""
-            self.curmorph = ""
-            self.cur_word_id = ""
-            self.cur_word_type = ""
-            self.cur_word_n = ""
-            self.bInW = False
-            self.bAddToCurrent = False
-            self.bAddSpaceToCurrent = False
-        elif tag == "seg":
-            self.bInSeg = False
-            if self.seg_type == "x-maqqef":
-                self.bAddToCurrent = True
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-sof-pasuq":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-            elif self.seg_type == "x-pe":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-                self.endParagraph("pe")
-                self.startParagraph()
-            elif self.seg_type == "x-samekh":
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-                self.endParagraph("samekh")
-                self.startParagraph()
-            else:
-                self.bAddToCurrent = False
-                self.bAddSpaceToCurrent = False
-        elif tag == "verse":
-            self.endVerse()
-        elif tag == "catchWord":
-            #self.addNonBibleToken(" (Kethiv) ")
-            self.bInCatchWord = False
-            objectTypeName = self.tag2objectTypeName[tag]
-            self.endObject(objectTypeName)
-        elif tag == "rdg":
-            #self.addNonBibleToken(" (Qere) ")
-            objectTypeName = self.tag2objectTypeName[tag]
-            self.endObject(objectTypeName)
-        elif tag == "note":
-            self.bInNote = False
-            if self.note_type == "":
-                pass
-            elif self.note_type == "variant":
-                pass
-            else:
-                self.endObject("note")
-                self.bInNote = False
-        elif tag == "chapter":
-            pass # All done at start
-        elif tag == "title":
-            if self.divtypestack[-1] == "bookGroup":
-                self.endObject("title")
-            elif self.divtypestack[-1] == "book":
-                self.endObject("title")
-        elif tag == "div":
-            self.divtypestack.pop()
-            if self.divtypestack[-1] == "bookGroup":
-                pass # All done at start
-            elif self.divtypestack[-1] == "book":
-                pass # All done at start
+            self.endBook()
+            self.startBook(attributes["osisID"])
+
+    def endDiv(self, tag):
+        self.divtypestack.pop()
+
+    def startNote(self, tag, attributes):
+        self.bInNote = True
+        self.note_type = attributes.get("type", "")
+        if self.note_type not in ["", "variant"]:
+            self.createObject("note")
+
+    def endNote(self, tag):
+        self.bInNote = False
+        if self.note_type not in ["", "variant"]:
+            self.endObject("note")
+
+    def startCatchWord(self, tag, attributes):
+        self.bInCatchWord = True
+        self.startSimpleSR(tag, attributes)
+
+    def endCatchWord(self, tag):
+        #self.addNonBibleToken(" (Kethiv) ")
+        self.bInCatchWord = False
+        self.endSimpleSR(tag)
+
+    @classmethod
+    def buildTagHandlers(cls):
+        cls.tag_handlers = {}
+        for tag in cls.nixed_elements:
+            cls.tag_handlers[tag] = (cls.startNixed, cls.endNixed)
+        for tag in cls.ignored_elements:
+            cls.tag_handlers[tag] = (cls.startNothing, cls.endNothing)
+        for tag in cls.simple_SR_elements:
+            cls.tag_handlers[tag] = (cls.startSimpleSR, cls.endSimpleSR)
+        for tag in cls.word_elements:
+            cls.tag_handlers[tag] = (cls.startWord, cls.endWord)
+        for tag in cls.name_elements:
+            # The text is taken in handleChars.
+            cls.tag_handlers[tag] = (cls.startNothing, cls.endNothing)
+        for tag in cls.paragraph_elements:
+            cls.tag_handlers[tag] = (cls.startParagraphElement, cls.endNothing)
+        cls.tag_handlers["names"] = (cls.startNames, cls.endNames)
+        cls.tag_handlers["c"] = (cls.startC, cls.endNothing)
+        cls.tag_handlers["v"] = (cls.startV, cls.endNothing)
+        cls.tag_handlers["seg"] = (cls.startSeg, cls.endSeg)
+        cls.tag_handlers["chapter"] = (cls.startOSISChapter, cls.endNothing)
+        cls.tag_handlers["verse"] = (cls.startNothing, cls.endOSISVerse)
+        cls.tag_handlers["title"] = (cls.startTitle, cls.endTitle)
+        cls.tag_handlers["div"] = (cls.startDiv, cls.endDiv)
+        cls.tag_handlers["note"] = (cls.startNote, cls.endNote)
+        cls.tag_handlers["catchWord"] = (cls.startCatchWord, cls.endCatchWord)
+        cls.tag_handlers["rdg"] = (cls.startSimpleSR, cls.endSimpleSR)
 
     def startParagraphIfNotStarted(self):
         if self.paragraph_first_monad < 0:
@@ -508,7 +1015,7 @@ class TanakhHandler(xml.sax.ContentHandler):
             obj.setNonStringFeature("docindex", self.paragraph_docindex)
             obj.setLastMonad(self.curmonad-1)
             obj.setStringFeature("class", paragraph_class)
-            self.objects.setdefault(objectTypeName, []).append(obj)
+            self.addObject(obj)
             self.paragraph_first_monad = -1
             self.paragraph_docindex = -1
 
@@ -519,12 +1026,15 @@ class TanakhHandler(xml.sax.ContentHandler):
         obj.setNonStringFeature("docindex", self.curdocindex)
         self.curdocindex += 1
         self.curBook = obj
+        self.curosisBook = osisID
+        self.outlist.append("<book osisID=\"%s\">\n" % mangle_XML_entities(osisID))
 
     def endBook(self):
         if self.curBook != None:
             self.curBook.setLastMonad(self.curmonad-1)
-            self.objects.setdefault("book", []).append(self.curBook)
+            self.addObject(self.curBook)
             self.curBook = None
+            self.outlist.append("</book>\n")
 
 
     def startChapter(self, osisID):
@@ -533,17 +1043,20 @@ class TanakhHandler(xml.sax.ContentHandler):
         obj.setStringFeature("osisID", osisID)
         (osisBook, osisChapterStr) = osisID.split(".")
         obj.setStringFeature("osisBook", osisBook)
-        obj.setNonStringFeature("chapter", osisChapterStr)
+        obj.setNonStringFeature("chapter", int(osisChapterStr))
         obj.setNonStringFeature("docindex", self.curdocindex)
         self.curdocindex += 1
         self.curChapter = obj
+        self.curosisChapter = osisID
+        self.outlist.append("<chapter osisID=\"%s\">\n" % mangle_XML_entities(osisID))
 
     def endChapter(self):
         self.bInChapter = False
         if self.curChapter != None:
             self.curChapter.setLastMonad(self.curmonad-1)
-            self.objects.setdefault("chapter", []).append(self.curChapter)
+            self.addObject(self.curChapter)
             self.curChapter = None
+            self.outlist.append("</chapter>\n")
 
 
     def startVerse(self, osisID):
@@ -551,23 +1064,56 @@ class TanakhHandler(xml.sax.ContentHandler):
         obj.setStringFeature("osisID", " %s " % osisID)
         (osisBook, osisChapterStr, osisVerseStr) = osisID.split(".")
         obj.setStringFeature("osisBook", osisBook)
-        obj.setNonStringFeature("chapter", osisChapterStr)
-        obj.setNonStringFeature("verse", osisVerseStr)
+        obj.setNonStringFeature("chapter", int(osisChapterStr))
+        obj.setNonStringFeature("verse", int(osisVerseStr))
         obj.setNonStringFeature("docindex", self.curdocindex)
         self.curdocindex += 1
 
         self.curVerse = obj
+        if self.aligner != None:
+            self.aligner.startVerse(osisID)
+        self.outlist.append("<verse osisID=\"%s\">\n" % mangle_XML_entities(osisID))
+
+    def endKQ(self):
+        # One kq object per ketiv/qere pair: the run of <k> words and
+        # the run of <q> words after it, either of which may be empty
+        # (ketiv wela qere, qere wela ketiv).  It spans both readings,
+        # the ketiv's ketiv_count words first, so that either reading
+        # can be shown in the text and the other in the margin.
+        if len(self.kq_ketiv) == 0 and len(self.kq_qere) == 0:
+            return
+        readings = self.kq_ketiv + self.kq_qere
+        obj = SRObject("kq", readings[0][0])
+        obj.setLastMonad(readings[-1][0])
+        if len(self.kq_qere) == 0:
+            obj.setStringFeature("kq_type", "ketiv-only")
+        elif len(self.kq_ketiv) == 0:
+            obj.setStringFeature("kq_type", "qere-only")
+        else:
+            obj.setStringFeature("kq_type", "ketiv-qere")
+        for (name, words) in [("ketiv", self.kq_ketiv), ("qere", self.kq_qere)]:
+            obj.setNonStringFeature(name + "_count", len(words))
+            obj.setStringFeature(name, " ".join([surface for (monad, surface) in words]))
+        obj.setStringFeature("osisID", self.curVerse.getStringFeature("osisID"))
+        self.addObject(obj)
+        self.kq_ketiv = []
+        self.kq_qere = []
 
     def endVerse(self):
+        self.endKQ()
         if self.curVerse != None:
             self.curVerse.setLastMonad(self.curmonad-1)
-            self.objects.setdefault("verse", []).append(self.curVerse)
+            self.addObject(self.curVerse)
             self.curVerse = None
+            self.outlist.append("</verse>\n")
+            self.flushXML()
 
     def endElement(self, tag):
-        chars = "".join(self.charstack)
-        del self.charstack
-        self.charstack = []
+        if len(self.charstack) == 0:
+            chars = ""
+        else:
+            chars = "".join(self.charstack)
+            self.charstack = []
 
         self.handleChars(chars, tag, True)
 
@@ -576,104 +1122,2139 @@ class TanakhHandler(xml.sax.ContentHandler):
         self.curmonad += 1
 
 
-        if tag in self.nixed_elements:
-            oldTag = self.nixing_stack.pop()
-            assert tag == oldTag
-        elif len(self.nixing_stack) != 0:
-            if self.nixing_stack[-1] == tag:
+        if len(self.nixing_stack) != 0:
+            if tag in self.nixed_elements:
+                self.endNixed(tag)
+            elif self.nixing_stack[-1] == tag:
                 self.nixing_stack.pop()
-        elif tag in self.simple_SR_elements:
-            objectTypeName = self.tag2objectTypeName[tag]
-            self.endObject(objectTypeName)
-        elif tag in self.handled_elements:
-            self.handleElementEnd(tag)
-        elif tag in self.ignored_elements:
-            pass
         else:
-            raise Exception(("Error: Unknown end-tag " + tag).encode('utf-8'))
+            handlers = self.tag_handlers.get(tag)
+            if handlers == None:
+                raise Exception(("Error: Unknown end-tag " + tag).encode('utf-8'))
+            handlers[1](self, tag)
 
         self.elemstack.pop()
 
 
     def dumpMQL(self, fout):
-        myobject_types = list(sorted(self.objects.keys()))
-
-        for objectTypeName in myobject_types:
+        dumpMQL(fout, self.objects, self.tokens, self.non_bible_tokens, self.stats)
+
+    def flushXML(self):
+        if self.xmlwriter != None:
+            self.xmlwriter.writeParts(self.outlist)
+            self.outlist = []
+
+    def getXML(self):
+        assert self.xmlwriter == None, "The XML has gone to the xmlwriter."
+        return "".join(self.outlist)
+
+    def dumpXML(self, outfilename):
+        writeMassagedXML(outfilename, self.getXML())
+
+TanakhHandler.buildTagHandlers()
+
+
+class MassagedXMLWriter:
+    # Writes a massaged XML file as TanakhHandler produces it, encoding
+    # and writing in chunks of about chunk_size characters, so that a
+    # book is never held in memory as a whole.  The file is renamed into
+    # place by close(), so that a reader never sees half a book, or
+    # thrown away by abort().
+    def __init__(self, outfilename, chunk_size=1 << 18):
+        self.outfilename = outfilename
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+        self.atomic = AtomicFile(outfilename)
+        self.fout = self.atomic.fout
+        self.fout.write(b"<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n")
+
+    def writeParts(self, parts):
+        self.parts.extend(parts)
+        self.size += sum(map(len, parts))
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.fout.write("".join(self.parts).encode('utf-8'))
+        self.parts = []
+        self.size = 0
+
+    def close(self):
+        try:
+            self.flush()
+        except BaseException:
+            self.atomic.abort()
+            raise
+        self.atomic.commit()
+
+    def abort(self):
+        self.parts = []
+        self.atomic.abort()
+
+
+def writeMassagedXML(outfilename, xmltext):
+    writer = MassagedXMLWriter(outfilename)
+    writer.writeParts([xmltext])
+    writer.close()
+
+
+def copyFileAtomically(infilename, outfilename):
+    fin = open(infilename, "rb")
+    try:
+        with atomicOutput(outfilename) as fout:
+            shutil.copyfileobj(fin, fout)
+    finally:
+        fin.close()
+
+
+default_batch_size = 50000
+
+def dumpMQLBatches(fout, objectTypeName, renderings, stats=None, batch_size=default_batch_size):
+    # Writes the rendered objects of one object type in transactions of
+    # batch_size, with a single write per transaction.  A new transaction
+    # is only begun once there is an object to put in it, so at most
+    # batch_size objects make exactly one.
+    create = "CREATE OBJECTS WITH OBJECT TYPE [%s]\n" % objectTypeName
+    parts = ["BEGIN TRANSACTION GO\n", create]
+    count = 0
+    if stats != None:
+        batch_start = time.perf_counter()
+    for mql in renderings:
+        if count == batch_size:
+            parts.append("GO COMMIT TRANSACTION GO\nBEGIN TRANSACTION GO\n")
+            parts.append(create)
+            fout.write("".join(parts).encode('utf-8'))
+            parts = []
             count = 0
+            if stats != None:
+                stats.addDumpBatch(objectTypeName, batch_size, time.perf_counter() - batch_start)
+                batch_start = time.perf_counter()
+        parts.append(mql)
+        count += 1
+    parts.append("GO\n")
+    parts.append("COMMIT TRANSACTION GO\n")
+    fout.write("".join(parts).encode('utf-8'))
+    if stats != None:
+        stats.addDumpBatch(objectTypeName, count, time.perf_counter() - batch_start)
 
-            sys.stderr.write("Now dumping [%s] ...\n" % objectTypeName)
 
-            fout.write(b"BEGIN TRANSACTION GO\n")
-            fout.write(("CREATE OBJECTS WITH OBJECT TYPE [%s]\n" % objectTypeName).encode('utf-8'))
-            for obj in self.objects[objectTypeName]:
-                obj.dumpMQL(fout)
-                count += 1
-                if count == 50000:
-                    fout.write(b"GO COMMIT TRANSACTION GO\nBEGIN TRANSACTION GO\n")
-                    fout.write(("CREATE OBJECTS WITH OBJECT TYPE [%s]\n" % objectTypeName).encode('utf-8'))
-                    count = 0
-            fout.write(b"GO\n")
-            fout.write(b"COMMIT TRANSACTION GO\n")
+def dumpMQL(fout, objects, tokens, non_bible_tokens, stats=None, batch_size=default_batch_size):
+    myobject_types = list(sorted(objects.keys()))
 
+    for objectTypeName in myobject_types:
+        dumpMQLBatches(fout, objectTypeName, [obj.renderMQL() for obj in objects[objectTypeName]], stats, batch_size)
 
-        count = 0
+    dumpMQLBatches(fout, "Token", tokens.iterMQL(), stats, batch_size)
 
-        sys.stderr.write("Now dumping [Token] ...\n")
+    dumpMQLBatches(fout, "NonBibleToken", [obj.renderMQL() for obj in non_bible_tokens], stats, batch_size)
 
-        fout.write(b"BEGIN TRANSACTION GO\n")
-        fout.write(b"CREATE OBJECTS WITH OBJECT TYPE [Token]\n")
-        for obj in self.tokens:
-            obj.dumpMQL(fout)
-            count += 1
-            if count == 50000:
-                fout.write(b"GO COMMIT TRANSACTION GO\nBEGIN TRANSACTION GO\n")
-                fout.write(b"CREATE OBJECTS WITH OBJECT TYPE [Token]\n")
-                count = 0
-        fout.write(b"GO\n")
-        fout.write(b"COMMIT TRANSACTION GO\n")
+    fout.write(b"VACUUM DATABASE ANALYZE GO\n")
+
+
+########################################
+##
+## Sharded MQL output
+##
+########################################
+def getMQLSchema(objects):
+    # Emdros does not get the object types from wlc.mql itself, so the
+    # shards come with a schema derived from the features actually set.
+    # Non-string features become INTEGER if every value is a number,
+    # and an enumeration of the values seen otherwise.
+    enumerations = [("language_e", list(language_names.values()))]
+    object_types = []
+    for objectTypeName in sorted(objects.keys()):
+        features = []
+        non_string = {}
+        for obj in objects[objectTypeName]:
+            for name in obj.nonStringFeatures:
+                non_string.setdefault(name, []).append(obj.nonStringFeatures[name])
+        for name in non_string:
+            values = non_string[name]
+            if all([type(value) == int or (type(value) == str and value.isdigit()) for value in values]):
+                features.append((name, "INTEGER"))
+            else:
+                enumeration = "%s_%s_e" % (objectTypeName, name)
+                enumerations.append((enumeration, sorted(set([str(value) for value in values]))))
+                features.append((name, enumeration))
+        string_names = []
+        for obj in objects[objectTypeName]:
+            for name in obj.stringFeatures:
+                if name not in string_names:
+                    string_names.append(name)
+        features.extend([(name, "STRING") for name in string_names])
+        object_types.append((objectTypeName, "SINGLE RANGE", features))
+    object_types.append(("Token", "SINGLE MONAD", [("surface", "STRING"), ("pointed", "STRING"), ("consonantal", "STRING"), ("language", "language_e"), ("docindex", "INTEGER"), ("word_id", "STRING"), ("word_type", "STRING"), ("word_n", "STRING"), ("morph", "STRING"), ("strongs", "STRING")]))
+    object_types.append(("NonBibleToken", "SINGLE MONAD", [("wholesurface", "STRING"), ("docindex", "INTEGER")]))
+
+    parts = []
+    for (enumeration, constants) in enumerations:
+        parts.append("CREATE ENUMERATION %s = { %s } GO\n" % (enumeration, ", ".join(constants)))
+    for (objectTypeName, range_type, features) in object_types:
+        parts.append("CREATE OBJECT TYPE WITH %s OBJECTS [%s\n" % (range_type, objectTypeName))
+        for (name, feature_type) in features:
+            parts.append("  %s : %s;\n" % (name, feature_type))
+        parts.append("] GO\n")
+    schema = {
+        "enumerations" : dict(enumerations),
+        "object_types" : dict([(objectTypeName, {"range" : range_type, "features" : dict(features)}) for (objectTypeName, range_type, features) in object_types]),
+    }
+    return ("".join(parts), schema)
+
+
+shard_filename_re = re.compile(r'^[0-9]{2}-[A-Za-z_]+-[0-9]{4}\.mql$')
+
+def dumpMQLShards(outdir, objects, tokens, non_bible_tokens, batch_size=default_batch_size):
+    # One file per object type and batch_size objects, each a single
+    # transaction, and loadable on its own once schema.mql has been
+    # run.  manifest.json gives the order: the schema first, then the
+    # shards in any order or concurrently, then the "finally" statement.
+    # The manifest is removed first and written last, so that it only
+    # ever lists a complete set of shards.
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifestfilename = os.path.join(outdir, "manifest.json")
+    if os.path.exists(manifestfilename):
+        os.remove(manifestfilename)
+
+    (schema_mql, schema) = getMQLSchema(objects)
+    with atomicOutput(os.path.join(outdir, "schema.mql")) as fout:
+        fout.write(schema_mql.encode('utf-8'))
+
+    tables = []
+    for objectTypeName in sorted(objects.keys()):
+        objs = objects[objectTypeName]
+        tables.append((objectTypeName, len(objs), [obj.renderMQL() for obj in objs], [(obj.fm, obj.lm) for obj in objs]))
+    tables.append(("Token", len(tokens), tokens.iterMQL(), [(monad, monad) for monad in tokens.monads]))
+    tables.append(("NonBibleToken", len(non_bible_tokens), [obj.renderMQL() for obj in non_bible_tokens], [(obj.monad, obj.monad) for obj in non_bible_tokens]))
+
+    shards = []
+    for (table_number, (objectTypeName, count, renderings, monad_ranges)) in enumerate(tables):
+        renderings = iter(renderings)
+        for (batch_number, start) in enumerate(range(0, count, batch_size)):
+            end = min(start + batch_size, count)
+            filename = "%02d-%s-%04d.mql" % (table_number, objectTypeName, batch_number)
+            with atomicOutput(os.path.join(outdir, filename)) as fout:
+                dumpMQLBatches(fout, objectTypeName, itertools.islice(renderings, end - start), batch_size=batch_size)
+            shards.append({
+                "file" : filename,
+                "object_type" : objectTypeName,
+                "objects" : end - start,
+                "first_monad" : min([fm for (fm, lm) in monad_ranges[start:end]]),
+                "last_monad" : max([lm for (fm, lm) in monad_ranges[start:end]]),
+            })
+
+    manifest = {
+        "batch_size" : batch_size,
+        "schema" : schema,
+        "load_order" : [["schema.mql"], [shard["file"] for shard in shards]],
+        "shards" : shards,
+        "finally" : "VACUUM DATABASE ANALYZE GO",
+    }
+    with atomicOutput(manifestfilename, "w", "utf-8") as fout:
+        json.dump(manifest, fout, indent=2)
+        fout.write("\n")
+
+    # Shards left over from a run with more of them.
+    filenames = set([shard["file"] for shard in shards])
+    for filename in os.listdir(outdir):
+        if shard_filename_re.match(filename) and filename not in filenames:
+            os.remove(os.path.join(outdir, filename))
+
+
+########################################
+##
+## Streaming MQL output
+##
+########################################
+class MQLSpool:
+    # All objects of one object type, already rendered as MQL, in a
+    # temporary file.  Batch boundaries are written as we go, so the
+    # spool can be copied verbatim into the final output.  If timed,
+    # the time spent rendering and spooling each batch is kept in
+    # batches, as (objects, seconds).
+    def __init__(self, objectTypeName, batch_size=default_batch_size, bTimed=False):
+        self.objectTypeName = objectTypeName
+        self.batch_size = batch_size
+        self.bTimed = bTimed
+        self.count = 0
+        self.total = 0
+        self.parts = []
+        self.batches = []
+        self.batch_seconds = 0.0
+        self.f = tempfile.TemporaryFile()
+
+    def add(self, obj):
+        # Batches are closed the same way as in dumpMQLBatches().
+        if self.bTimed:
+            start = time.perf_counter()
+        if self.count == self.batch_size:
+            self.parts.append("GO COMMIT TRANSACTION GO\nBEGIN TRANSACTION GO\n")
+            self.parts.append("CREATE OBJECTS WITH OBJECT TYPE [%s]\n" % self.objectTypeName)
+            if self.bTimed:
+                self.batches.append((self.count, self.batch_seconds))
+                self.batch_seconds = 0.0
+            self.count = 0
+        self.parts.append(obj.renderMQL())
+        self.count += 1
+        self.total += 1
+        if len(self.parts) >= 4096:
+            self.flush()
+        if self.bTimed:
+            self.batch_seconds += time.perf_counter() - start
+
+    def flush(self):
+        self.f.write("".join(self.parts).encode('utf-8'))
+        self.parts = []
 
-        count = 0
+    def dumpMQL(self, fout):
+        self.flush()
+        if self.bTimed:
+            self.batches.append((self.count, self.batch_seconds))
+            self.batch_seconds = 0.0
         fout.write(b"BEGIN TRANSACTION GO\n")
-        fout.write(b"CREATE OBJECTS WITH OBJECT TYPE [NonBibleToken]\n")
-        for obj in self.non_bible_tokens:
-            obj.dumpMQL(fout)
-            count += 1
-            if count == 50000:
-                fout.write(b"GO COMMIT TRANSACTION GO\nBEGIN TRANSACTION GO\n")
-                fout.write(b"CREATE OBJECTS WITH OBJECT TYPE [NonBibleToken]\n")
-                count = 0
+        fout.write(("CREATE OBJECTS WITH OBJECT TYPE [%s]\n" % self.objectTypeName).encode('utf-8'))
+        self.f.seek(0)
+        shutil.copyfileobj(self.f, fout)
         fout.write(b"GO\n")
         fout.write(b"COMMIT TRANSACTION GO\n")
 
+    def close(self):
+        self.f.close()
+
+
+class MQLSpooler:
+    # Receives objects and tokens as the handler closes them, and writes
+    # the same layout as dumpMQL() without keeping them in memory.
+    def __init__(self, batch_size=default_batch_size, bTimed=False):
+        self.batch_size = batch_size
+        self.bTimed = bTimed
+        self.spools = {}
+        self.token_spool = MQLSpool("Token", batch_size, bTimed)
+        self.non_bible_token_spool = MQLSpool("NonBibleToken", batch_size, bTimed)
+
+    def addObject(self, obj):
+        objectTypeName = obj.objectTypeName
+        if objectTypeName not in self.spools:
+            self.spools[objectTypeName] = MQLSpool(objectTypeName, self.batch_size, self.bTimed)
+        self.spools[objectTypeName].add(obj)
+
+    def addToken(self, token):
+        self.token_spool.add(token)
+
+    def addNonBibleToken(self, token):
+        self.non_bible_token_spool.add(token)
+
+    def dumpMQL(self, fout, stats=None):
+        # The objects were rendered as they came in, so the batches are
+        # timed as the spools filled up rather than here.
+        spools = [self.spools[objectTypeName] for objectTypeName in sorted(self.spools.keys())]
+        spools.append(self.token_spool)
+        spools.append(self.non_bible_token_spool)
+        for spool in spools:
+            spool.dumpMQL(fout)
+            if stats != None:
+                for (count, seconds) in spool.batches:
+                    stats.addDumpBatch(spool.objectTypeName, count, seconds)
+
         fout.write(b"VACUUM DATABASE ANALYZE GO\n")
 
-        sys.stderr.write("Finished dumping Book!\n")
-        
+    def close(self):
+        for spool in self.spools.values():
+            spool.close()
+        self.token_spool.close()
+        self.non_bible_token_spool.close()
 
 
 
+########################################
+##
+## Instrumentation
+##
+########################################
+class RunStats:
+    # Counters for one book, or for a whole run once the books' stats
+    # have been added up.
+    def __init__(self):
+        self.books = 0
+        self.books_cached = 0
+        self.parse_seconds = 0.0
+        self.start_tags = {}
+        self.end_tags = {}
+        self.objects = {}
+        self.charstack_total = 0
+        self.charstack_max = 0
+        self.mangle_calls = 0
+        self.mangle_hits = 0
+        self.mangle_info = None
+        self.dump_batches = []
+
+    # Everything is mangled in the main process, whether while a
+    # spooler takes the books or while dumpMQL() writes them, so one
+    # window around the whole run counts every call exactly once.
+    def startMangling(self):
+        self.mangle_info = mangleMQLString.cache_info()
+
+    def endMangling(self):
+        if self.mangle_info == None:
+            return
+        info = mangleMQLString.cache_info()
+        hits = info.hits - self.mangle_info.hits
+        self.mangle_hits += hits
+        self.mangle_calls += hits + info.misses - self.mangle_info.misses
+        self.mangle_info = None
+
+    def addDumpBatch(self, objectTypeName, count, seconds):
+        self.dump_batches.append((objectTypeName, count, seconds))
+
+    def addBook(self, other):
+        if other == None:
+            self.books_cached += 1
+            return
+        self.books += other.books
+        self.parse_seconds += other.parse_seconds
+        for (mine, theirs) in [(self.start_tags, other.start_tags), (self.end_tags, other.end_tags), (self.objects, other.objects)]:
+            for key in theirs:
+                mine[key] = mine.get(key, 0) + theirs[key]
+        self.charstack_total += other.charstack_total
+        self.charstack_max = max(self.charstack_max, other.charstack_max)
+        self.dump_batches.extend(other.dump_batches)
+
+    def writeSummary(self, f):
+        f.write("Books parsed: %d (%.3f s), taken from cache: %d\n" % (self.books, self.parse_seconds, self.books_cached))
+        f.write("Elements:\n")
+        for tag in sorted(set(self.start_tags.keys()) | set(self.end_tags.keys())):
+            f.write("  %-16s %8d start %8d end\n" % (tag, self.start_tags.get(tag, 0), self.end_tags.get(tag, 0)))
+        f.write("Objects created:\n")
+        for objectTypeName in sorted(self.objects.keys()):
+            f.write("  %-12s %8d\n" % (objectTypeName, self.objects[objectTypeName]))
+        f.write("Character buffer: %d chars in all, at most %d at once\n" % (self.charstack_total, self.charstack_max))
+        if self.mangle_calls > 0:
+            f.write("mangleMQLString: %d calls, %d cache hits (%.1f%%)\n" % (self.mangle_calls, self.mangle_hits, 100.0 * self.mangle_hits / self.mangle_calls))
+        else:
+            f.write("mangleMQLString: 0 calls\n")
+        f.write("dumpMQL batches:\n")
+        for (objectTypeName, count, seconds) in self.dump_batches:
+            f.write("  %-12s %8d objects %8.3f s\n" % (objectTypeName, count, seconds))
+
+
+class InstrumentedTanakhHandler(TanakhHandler):
+    # A TanakhHandler which fills in a RunStats as it goes.  It is a
+    # subclass so that the plain handler pays nothing for it.
+    def __init__(self, bookname, first_monad=1, spooler=None, aligner=None):
+        TanakhHandler.__init__(self, bookname, first_monad, spooler, aligner)
+        self.stats = RunStats()
+        self.stats.books = 1
+
+    def countCharstack(self):
+        size = 0
+        for chars in self.charstack:
+            size += len(chars)
+        self.stats.charstack_total += size
+        if size > self.stats.charstack_max:
+            self.stats.charstack_max = size
 
+    def startElement(self, tag, attributes):
+        self.stats.start_tags[tag] = self.stats.start_tags.get(tag, 0) + 1
+        self.countCharstack()
+        TanakhHandler.startElement(self, tag, attributes)
 
-#booknames_Tanakh = ["Gen","Exod","Lev","Num", "Deut", "Josh", "Judg", "Ruth","1Sam","2Sam", "1Kgs","2Kgs","1Chr", "2Chr","Ezra","Neh","Esth","Job","Ps","Prov","Eccl","Song","Isa", "Jer","Lam","Ezek","Dan","Hos","Joel","Amos","Obad","Jonah","Mic","Nah","Hab","Zeph","Hag","Zech","Mal"]
-booknames_Tanakh = ["Genesis"]
+    def endElement(self, tag):
+        self.stats.end_tags[tag] = self.stats.end_tags.get(tag, 0) + 1
+        self.countCharstack()
+        TanakhHandler.endElement(self, tag)
+
+    def addObject(self, obj):
+        self.stats.objects[obj.objectTypeName] = self.stats.objects.get(obj.objectTypeName, 0) + 1
+        TanakhHandler.addObject(self, obj)
+
+    def addToken(self, monad, surface, morph, strongs, word_id, word_type, word_n, language, docindex):
+        self.stats.objects["Token"] = self.stats.objects.get("Token", 0) + 1
+        TanakhHandler.addToken(self, monad, surface, morph, strongs, word_id, word_type, word_n, language, docindex)
+
+
+########################################
+##
+## Parser backends
+##
+########################################
+parser_backends = ["sax", "expat", "lxml"]
+
+class LxmlTarget:
+    # An lxml parser target which passes the events straight on to a
+    # TanakhHandler.  No tree is built, so there is nothing to clear.
+    def __init__(self, handler):
+        self.start = handler.startElement
+        self.end = handler.endElement
+        self.data = handler.characters
+
+    def close(self):
+        return None
+
+
+def parseBook(fin, handler, parser_backend):
+    if parser_backend == "sax":
+        xml.sax.parse(fin, handler)
+    elif parser_backend == "expat":
+        # The same expat that xml.sax uses, minus the layer in between.
+        # Text comes in one piece per run of characters, and tag names
+        # are interned.
+        parser = xml.parsers.expat.ParserCreate(intern={})
+        parser.buffer_text = True
+        parser.buffer_size = 1 << 16
+        parser.StartElementHandler = handler.startElement
+        parser.EndElementHandler = handler.endElement
+        parser.CharacterDataHandler = handler.characters
+        handler.startDocument()
+        parser.ParseFile(fin)
+        handler.endDocument()
+    elif parser_backend == "lxml":
+        if lxml_etree == None:
+            raise Exception("ERROR: The lxml parser backend needs lxml, which is not installed.")
+        parser = lxml_etree.XMLParser(target=LxmlTarget(handler), resolve_entities=False, huge_tree=True)
+        handler.startDocument()
+        lxml_etree.parse(fin, parser)
+        handler.endDocument()
+    else:
+        raise Exception("ERROR: Unknown parser backend: '%s'" % parser_backend)
+
+
+########################################
+##
+## morphhb alignment
+##
+########################################
+#
+# UXLC has no morphology.  morphhb (OSHB) has it, on the same WLC
+# text, so its words are indexed per book by verse and position, and
+# by verse and consonantal text, and each UXLC word is looked up as it
+# is tokenized.  Main-line words (w, k) and qere words (q) are counted
+# separately, since morphhb keeps the qere in notes.
+non_consonant_re = re.compile(r'[^א-ת]')
 
-booknames_Gen = ["Gen"]
+def getConsonants(surface):
+    return non_consonant_re.sub("", surface)
 
-for bookname in booknames_Tanakh:
-#for bookname in booknames_Gen: 
-    handler = TanakhHandler(bookname)
 
-    infilename = os.path.join('tanach.us', 'Books', '%s.xml' % bookname)
+def getMorphhbFilename(morphhbdir, bookname):
+    # "Genesis.DH" is still Genesis to morphhb.
+    return os.path.join(morphhbdir, "%s.xml" % filename2osisBook[bookname.split(".")[0]])
+
+
+class MorphhbHandler(xml.sax.ContentHandler):
+    # Collects the words of one morphhb book as
+    # (osisID, stream, surface, morph, lemma) tuples, in text order.
+    def __init__(self):
+        self.words = []
+        self.curVerse = ""
+        self.bInNote = False
+        self.bInQere = False
+        self.bInW = False
+        self.charstack = []
+        self.attributes = None
+
+    def startElement(self, tag, attributes):
+        if tag == "verse" and "osisID" in attributes:
+            self.curVerse = attributes["osisID"]
+        elif tag == "note":
+            self.bInNote = True
+        elif tag == "rdg":
+            self.bInQere = attributes.get("type", "") == "x-qere"
+        elif tag == "w":
+            self.bInW = True
+            self.charstack = []
+            self.attributes = dict(attributes)
+
+    def endElement(self, tag):
+        if tag == "verse":
+            self.curVerse = ""
+        elif tag == "note":
+            self.bInNote = False
+            self.bInQere = False
+        elif tag == "rdg":
+            self.bInQere = False
+        elif tag == "w":
+            self.bInW = False
+            if self.bInNote and not self.bInQere:
+                return
+            if self.bInQere or self.attributes.get("type", "") == "x-qere":
+                stream = "x-qere"
+            else:
+                stream = ""
+            self.words.append((self.curVerse, stream, "".join(self.charstack), self.attributes.get("morph", ""), self.attributes.get("lemma", "")))
+
+    def characters(self, data):
+        if self.bInW:
+            self.charstack.append(data)
+
+
+class MorphhbAligner:
+    # Fills in morph, strongs and language for the words of one book.
+    # Each word costs two dictionary lookups; a word which is not at
+    # its own position in morphhb is looked for by its consonants in
+    # the rest of the verse.  Words left over on either side end up in
+    # self.mismatches.
+    def __init__(self, filename):
+        self.words = []
+        self.consumed = []
+        self.positions = {}
+        self.consonantal = {}
+        self.mismatches = []
+        self.curVerse = ""
+        self.curPositions = {"" : 0, "x-qere" : 0}
+
+        handler = MorphhbHandler()
+        fin = open(filename, "rb")
+        parseBook(fin, handler, "expat")
+        fin.close()
+
+        counts = {}
+        for (osisID, stream, surface, morph, lemma) in handler.words:
+            key = (osisID, stream)
+            position = counts.get(key, 0)
+            counts[key] = position + 1
+            index = len(self.words)
+            self.words.append((osisID, stream, position, surface, morph, lemma))
+            self.consumed.append(False)
+            self.positions[(osisID, stream, position)] = index
+            self.consonantal.setdefault((osisID, stream, getConsonants(surface)), []).append(index)
+
+    def startVerse(self, osisID):
+        self.curVerse = osisID
+        self.curPositions = {"" : 0, "x-qere" : 0}
+
+    def alignWord(self, surface, word_type):
+        # Returns (morph, strongs, language), or None if the word
+        # cannot be found.
+        consonants = getConsonants(surface)
+        if consonants == "":
+            # A paseq or the like, which morphhb has as a seg.
+            return None
+        if word_type == "x-qere":
+            stream = "x-qere"
+        else:
+            stream = ""
+        position = self.curPositions[stream]
+        self.curPositions[stream] = position + 1
+
+        index = self.positions.get((self.curVerse, stream, position))
+        if index == None or self.consumed[index] or getConsonants(self.words[index][3]) != consonants:
+            index = None
+            for candidate in self.consonantal.get((self.curVerse, stream, consonants), []):
+                if not self.consumed[candidate]:
+                    index = candidate
+                    break
+        if index == None:
+            self.mismatches.append((self.curVerse, stream, position, surface, "uxlc"))
+            return None
+
+        self.consumed[index] = True
+        morph = self.words[index][4]
+        lemma = self.words[index][5]
+        if morph == "":
+            language = "H"
+        else:
+            language = morph[0]
+            morph = morph[1:]
+        strongs = "/".join([s.strip() for s in lemma.split("/")])
+        return (morph, strongs, language)
+
+    def endBook(self):
+        for (index, word) in enumerate(self.words):
+            if not self.consumed[index]:
+                (osisID, stream, position, surface, morph, lemma) = word
+                self.mismatches.append((osisID, stream, position, surface, "morphhb"))
+
+
+def writeMorphhbMismatches(outfilename, mismatches):
+    # One line per word that did not align: where it is, which text it
+    # is only in ("uxlc" or "morphhb"), and the word itself.
+    with atomicOutput(outfilename, "w", "utf-8") as fout:
+        fout.write("osisID\ttype\tposition\tonly_in\tsurface\n")
+        for (osisID, stream, position, surface, only_in) in mismatches:
+            fout.write("%s\t%s\t%d\t%s\t%s\n" % (osisID, stream, position, only_in, surface))
+
+
+########################################
+##
+## Columnar binary export
+##
+########################################
+#
+# The file is laid out as:
+#
+#   magic (8 bytes) | directory offset (u64) | directory length (u64)
+#   ... sections, each starting on an 8-byte boundary ...
+#   directory (UTF-8 JSON)
+#
+# All numbers are little-endian.  Strings live in one heap: a u32
+# array of count+1 offsets into a block of UTF-8 data, so string i is
+# data[offsets[i]:offsets[i+1]].  A table is a set of equally long
+# columns, each either "int" (i32), "intstr" (i32, a decimal string in
+# the original), "str" (u32 string number; 0xffffffff if missing) or
+# "bytes" (u8).  wlccolumns.py reads this back through mmap.
+#
+columns_magic = b"WLCCOL\x00\x01"
+columns_version = 1
+columns_missing = 0xffffffff
+
+
+class StringHeap:
+    def __init__(self):
+        self.values = []
+        self.value2index = {}
+
+    def add(self, value):
+        index = self.value2index.get(value)
+        if index == None:
+            index = len(self.values)
+            self.values.append(value)
+            self.value2index[value] = index
+        return index
+
+
+class ColumnsWriter:
+    def __init__(self, fout):
+        self.fout = fout
+        self.pos = 0
+        self.heap = StringHeap()
+        self.tables = {}
+        self.write(columns_magic + struct.pack("<QQ", 0, 0))
+
+    def write(self, data):
+        self.fout.write(data)
+        self.pos += len(data)
+
+    def writeArray(self, arr):
+        # Pads to 8 bytes first, so that readers can cast in place.
+        if self.pos % 8 != 0:
+            self.write(b"\x00" * (8 - self.pos % 8))
+        pos = self.pos
+        if sys.byteorder != "little":
+            arr = array.array(arr.typecode, arr)
+            arr.byteswap()
+        self.write(arr.tobytes())
+        return pos
+
+    def addColumn(self, table, name, kind, arr):
+        self.tables[table]["columns"][name] = {"kind" : kind, "pos" : self.writeArray(arr)}
+
+    def addTable(self, table, count):
+        self.tables[table] = {"count" : count, "columns" : {}, "string_features" : [], "non_string_features" : []}
+
+    def addTokens(self, tokens):
+        tokens.computeVariants()
+        self.addTable("Token", len(tokens))
+        self.addColumn("Token", "monad", "int", tokens.monads)
+        self.addColumn("Token", "docindex", "int", tokens.docindexes)
+        for (name, column) in [("surface", tokens.surfaces), ("pointed", tokens.pointeds), ("consonantal", tokens.consonantals), ("morph", tokens.morphs), ("strongs", tokens.strongs), ("word_id", tokens.word_ids), ("word_type", tokens.word_types), ("word_n", tokens.word_ns), ("language", tokens.languages)]:
+            heap_indexes = [self.heap.add(value) for value in column.values]
+            self.addColumn("Token", name, "str", array.array('I', [heap_indexes[code] for code in column.codes]))
+
+    def addObjects(self, objectTypeName, objs):
+        self.addTable(objectTypeName, len(objs))
+        self.addColumn(objectTypeName, "fm", "int", array.array('i', [obj.fm for obj in objs]))
+        self.addColumn(objectTypeName, "lm", "int", array.array('i', [obj.lm for obj in objs]))
+        self.addColumn(objectTypeName, "id_d", "int", array.array('i', [obj.id_d for obj in objs]))
+
+        # Feature names in the order the objects have them, so that
+        # SRObjects read back render the same MQL.
+        for (attr, key) in [("nonStringFeatures", "non_string_features"), ("stringFeatures", "string_features")]:
+            names = []
+            for obj in objs:
+                for name in getattr(obj, attr):
+                    if name not in names:
+                        names.append(name)
+            self.tables[objectTypeName][key] = names
+            for name in names:
+                values = [getattr(obj, attr).get(name) for obj in objs]
+                self.addFeatureColumn(objectTypeName, "%s:%s" % (key, name), values)
+
+    def addFeatureColumn(self, table, name, values):
+        if all([type(value) == int and -2**31 <= value < 2**31 for value in values]):
+            self.addColumn(table, name, "int", array.array('i', values))
+        elif all([type(value) == str and value.isdigit() and str(int(value)) == value and int(value) < 2**31 for value in values]):
+            self.addColumn(table, name, "intstr", array.array('i', [int(value) for value in values]))
+        else:
+            indexes = [columns_missing if value == None else self.heap.add(str(value)) for value in values]
+            self.addColumn(table, name, "str", array.array('I', indexes))
+
+    def close(self):
+        offsets = array.array('I', [0])
+        data = []
+        pos = 0
+        for value in self.heap.values:
+            encoded = value.encode('utf-8')
+            data.append(encoded)
+            pos += len(encoded)
+            offsets.append(pos)
+        strings = {"count" : len(self.heap.values), "offsets" : self.writeArray(offsets), "data" : self.pos}
+        self.write(b"".join(data))
+
+        directory = json.dumps({"version" : columns_version, "strings" : strings, "tables" : self.tables}, sort_keys=True).encode('utf-8')
+        directory_pos = self.pos
+        self.write(directory)
+        self.fout.seek(len(columns_magic))
+        self.fout.write(struct.pack("<QQ", directory_pos, len(directory)))
+        self.fout.seek(0, os.SEEK_END)
+
+
+def dumpColumns(fout, objects, tokens):
+    writer = ColumnsWriter(fout)
+    for objectTypeName in sorted(objects.keys()):
+        writer.addObjects(objectTypeName, objects[objectTypeName])
+    writer.addTokens(tokens)
+    writer.close()
+
+
+########################################
+##
+## Ketiv/qere table
+##
+########################################
+# In "qere" mode the text is what is read: the qere is in the text and
+# the ketiv in the margin.  In "ketiv" mode it is what is written, the
+# other way around.
+ketivqere_modes = ["qere", "ketiv"]
+
+class KetivQereTable:
+    # Every ketiv/qere pair (kq object) by monad, with what to show and
+    # what to put in the margin worked out up front for each mode.
+    def __init__(self):
+        self.fms = array.array('i')
+        self.lms = array.array('i')
+        self.ketiv_counts = array.array('i')
+        self.osisIDs = []
+        self.kq_types = []
+        self.ketivs = []
+        self.qeres = []
+        self.hidden = {}
+        self.notes = {}
+
+    def addPair(self, fm, lm, ketiv_count, osisID, kq_type, ketiv, qere):
+        self.fms.append(fm)
+        self.lms.append(lm)
+        self.ketiv_counts.append(ketiv_count)
+        self.osisIDs.append(osisID)
+        self.kq_types.append(kq_type)
+        self.ketivs.append(ketiv)
+        self.qeres.append(qere)
+
+    def addObjects(self, objs):
+        for obj in objs:
+            self.addPair(obj.fm, obj.lm, obj.getFeature("ketiv_count"), obj.getStringFeature("osisID").strip(), obj.getStringFeature("kq_type"), obj.getStringFeature("ketiv"), obj.getStringFeature("qere"))
+
+    def build(self):
+        # For each mode: the monads not to show, and per pair, the
+        # monad to hang its marginal note on and the note's text.  A
+        # pair with nothing to show hangs its note on the word before.
+        for mode in ketivqere_modes:
+            hidden = set()
+            notes = []
+            for index in range(len(self.fms)):
+                ketiv_lm = self.fms[index] + self.ketiv_counts[index] - 1
+                if mode == "qere":
+                    hidden.update(range(self.fms[index], ketiv_lm + 1))
+                    shown_lm = self.lms[index] if ketiv_lm < self.lms[index] else self.fms[index] - 1
+                    note = self.ketivs[index]
+                else:
+                    hidden.update(range(ketiv_lm + 1, self.lms[index] + 1))
+                    shown_lm = ketiv_lm if self.ketiv_counts[index] > 0 else self.fms[index] - 1
+                    note = self.qeres[index]
+                notes.append((shown_lm, note))
+            self.hidden[mode] = hidden
+            self.notes[mode] = notes
+
+    def find(self, monad):
+        # The index of the pair which monad is in, or -1.
+        index = bisect.bisect_right(self.fms, monad) - 1
+        if index >= 0 and monad <= self.lms[index]:
+            return index
+        return -1
+
+    def isShown(self, monad, mode):
+        return monad not in self.hidden[mode]
+
+    def getNote(self, index, mode):
+        # (monad to hang it on, text) of the pair's marginal note.
+        return self.notes[mode][index]
+
+    def __len__(self):
+        return len(self.fms)
+
+    def dump(self, fout):
+        fout.write("osisID\tkq_type\tfm\tlm\tketiv_count\tketiv\tqere\n")
+        for index in range(len(self.fms)):
+            fout.write("%s\t%s\t%d\t%d\t%d\t%s\t%s\n" % (self.osisIDs[index], self.kq_types[index], self.fms[index], self.lms[index], self.ketiv_counts[index], self.ketivs[index], self.qeres[index]))
+
+    @staticmethod
+    def load(filename):
+        table = KetivQereTable()
+        fin = open(filename, "r", encoding="utf-8")
+        fin.readline()
+        for line in fin:
+            (osisID, kq_type, fm, lm, ketiv_count, ketiv, qere) = line.rstrip("\n").split("\t")
+            table.addPair(int(fm), int(lm), int(ketiv_count), osisID, kq_type, ketiv, qere)
+        fin.close()
+        table.build()
+        return table
+
+
+########################################
+##
+## Verse hashes
+##
+########################################
+#
+# One hash per verse, over its words (every feature but the docindex)
+# and the objects starting and ending in it, with monads counted from
+# the verse's first.  A chapter's hash is over its verses' numbers and
+# hashes, a book's over its chapters', and the manifest's over its
+# books', so an edit to a verse changes the hashes of that verse, its
+# chapter and its book, and nothing else.  Hashes are 64-bit BLAKE2b,
+# in hex.  The manifest is JSON:
+#
+#   {"version" : 1, "hash" : ..., "books" : {osisBook : {"hash" : ...,
+#    "chapters" : {chapter : {"hash" : ..., "verses" : {verse : hash}}}}}}
+#
+hashes_version = 1
+
+def getContentHash(parts):
+    h = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        h.update(part.encode('utf-8'))
+        h.update(b"\x1e")
+    return h.hexdigest()
+
+
+def getChildrenHash(children):
+    return getContentHash(["%s:%s" % (name, children[name]["hash"]) for name in children])
+
+
+def buildVerseHashes(objects, tokens):
+    # What starts and ends at each monad, other than the verses,
+    # chapters and books themselves.
+    starts = {}
+    ends = {}
+    for objectTypeName in sorted(objects.keys()):
+        if objectTypeName in ["book", "chapter", "verse"]:
+            continue
+        for obj in objects[objectTypeName]:
+            features = obj.getFeatures(True)
+            features.update(obj.getFeatures(False))
+            features.pop("docindex", None)
+            starts.setdefault(obj.fm, []).append("<%s %s" % (objectTypeName, json.dumps(features, sort_keys=True, ensure_ascii=False)))
+            ends.setdefault(obj.lm, []).append(">%s" % objectTypeName)
+
+    columns = [tokens.surfaces, tokens.morphs, tokens.strongs, tokens.languages, tokens.word_ids, tokens.word_types, tokens.word_ns]
+    monads = tokens.monads
+    books = {}
+    for verse in sorted(objects.get("verse", []), key=lambda obj: obj.fm):
+        parts = []
+        index = bisect.bisect_left(monads, verse.fm)
+        for monad in range(verse.fm, verse.lm + 1):
+            offset = monad - verse.fm
+            for start in starts.get(monad, []):
+                parts.append("%d%s" % (offset, start))
+            if index < len(monads) and monads[index] == monad:
+                parts.append("%d=%s" % (offset, "\x1f".join([column[index] for column in columns])))
+                index += 1
+            for end in ends.get(monad, []):
+                parts.append("%d%s" % (offset, end))
+        book = books.setdefault(verse.getStringFeature("osisBook"), {"chapters" : {}})
+        chapter = book["chapters"].setdefault(str(verse.getFeature("chapter")), {"verses" : {}})
+        chapter["verses"][str(verse.getFeature("verse"))] = getContentHash(parts)
+
+    for book in books.values():
+        for chapter in book["chapters"].values():
+            chapter["hash"] = getContentHash(["%s:%s" % (verse, chapter["verses"][verse]) for verse in chapter["verses"]])
+        book["hash"] = getChildrenHash(book["chapters"])
+    return {"version" : hashes_version, "hash" : getChildrenHash(books), "books" : books}
+
+
+def writeVerseHashes(outfilename, manifest):
+    with atomicOutput(outfilename, "w", "utf-8") as fout:
+        json.dump(manifest, fout, separators=(",", ":"))
+
+
+def readVerseHashes(filename):
+    fin = open(filename, "r", encoding="utf-8")
+    manifest = json.load(fin)
+    fin.close()
+    if manifest.get("version") != hashes_version:
+        raise Exception("ERROR: %s has version %s; expected %d." % (filename, manifest.get("version"), hashes_version))
+    return manifest
+
+
+def diffVerseHashes(old, new):
+    # The verses that differ, as (status, osisID), status being one of
+    # "added", "removed" and "changed".  Books and chapters whose hashes
+    # agree are not looked into.
+    result = []
+    if old["hash"] == new["hash"]:
+        return result
+    for (osisBook, old_book, new_book) in getHashDifferences(old["books"], new["books"]):
+        for (chapter, old_chapter, new_chapter) in getHashDifferences(old_book.get("chapters", {}), new_book.get("chapters", {})):
+            old_verses = old_chapter.get("verses", {})
+            new_verses = new_chapter.get("verses", {})
+            for verse in new_verses:
+                if verse not in old_verses:
+                    result.append(("added", "%s.%s.%s" % (osisBook, chapter, verse)))
+                elif old_verses[verse] != new_verses[verse]:
+                    result.append(("changed", "%s.%s.%s" % (osisBook, chapter, verse)))
+            for verse in old_verses:
+                if verse not in new_verses:
+                    result.append(("removed", "%s.%s.%s" % (osisBook, chapter, verse)))
+    return result
+
+
+def getHashDifferences(old_children, new_children):
+    # (name, old, new) of the children whose hashes differ, with {} for
+    # one that is missing on either side.
+    result = []
+    for name in new_children:
+        old_child = old_children.get(name, {})
+        if old_child.get("hash") != new_children[name]["hash"]:
+            result.append((name, old_child, new_children[name]))
+    for name in old_children:
+        if name not in new_children:
+            result.append((name, old_children[name], {}))
+    return result
+
+
+########################################
+##
+## Monad-range index
+##
+########################################
+class MonadIndex:
+    # Per object type, the objects sorted by first monad, with a running
+    # maximum of their last monads.  The objects containing monad m are
+    # then found by bisecting for the last fm <= m and walking back only
+    # as long as the running maximum still reaches m: O(log n + k).
+    #
+    # The index refers to objects by their row, i.e., their position in
+    # Corpus.objects[objectTypeName], in the MQL and in the columnar
+    # export.  It is stored as a columnar file of its own, and can be
+    # queried in place from there (see wlccolumns.loadMonadIndex).
+    def __init__(self):
+        self.fms = {}
+        self.lms = {}
+        self.max_lms = {}
+        self.rows = {}
+        self.token_monads = array.array('i')
+
+    def addObjects(self, objectTypeName, objs):
+        order = sorted(range(len(objs)), key=lambda row: (objs[row].fm, objs[row].lm))
+        self.fms[objectTypeName] = array.array('i', [objs[row].fm for row in order])
+        self.lms[objectTypeName] = array.array('i', [objs[row].lm for row in order])
+        self.rows[objectTypeName] = array.array('i', order)
+        max_lms = array.array('i')
+        max_lm = -1
+        for row in order:
+            max_lm = max(max_lm, objs[row].lm)
+            max_lms.append(max_lm)
+        self.max_lms[objectTypeName] = max_lms
+
+    def setTokens(self, tokens):
+        self.token_monads = tokens.monads
+
+    def getObjectTypeNames(self):
+        return sorted(self.fms.keys())
+
+    def getObjectsOverlapping(self, objectTypeName, first_monad, last_monad):
+        # Rows of the objects sharing at least one monad with
+        # [first_monad, last_monad], in order of first monad.
+        fms = self.fms[objectTypeName]
+        lms = self.lms[objectTypeName]
+        max_lms = self.max_lms[objectTypeName]
+        rows = self.rows[objectTypeName]
+        result = []
+        index = bisect.bisect_right(fms, last_monad) - 1
+        while index >= 0 and max_lms[index] >= first_monad:
+            if lms[index] >= first_monad:
+                result.append(rows[index])
+            index -= 1
+        result.reverse()
+        return result
+
+    def getObjectsContaining(self, objectTypeName, monad):
+        return self.getObjectsOverlapping(objectTypeName, monad, monad)
+
+    def getTokenRange(self, first_monad, last_monad):
+        # Token indexes [start, end) for the monads in [first_monad, last_monad].
+        return (bisect.bisect_left(self.token_monads, first_monad), bisect.bisect_right(self.token_monads, last_monad))
+
+    def dump(self, fout):
+        writer = ColumnsWriter(fout)
+        for objectTypeName in self.getObjectTypeNames():
+            writer.addTable(objectTypeName, len(self.fms[objectTypeName]))
+            writer.addColumn(objectTypeName, "fm", "int", self.fms[objectTypeName])
+            writer.addColumn(objectTypeName, "lm", "int", self.lms[objectTypeName])
+            writer.addColumn(objectTypeName, "max_lm", "int", self.max_lms[objectTypeName])
+            writer.addColumn(objectTypeName, "row", "int", self.rows[objectTypeName])
+        writer.addTable("Token", len(self.token_monads))
+        writer.addColumn("Token", "monad", "int", self.token_monads)
+        writer.close()
+
+    @staticmethod
+    def fromColumns(tables):
+        # `tables` maps table names to objects with a getColumn(name);
+        # columns may be arrays or memoryviews.
+        index = MonadIndex()
+        for name in tables:
+            if name == "Token":
+                index.token_monads = tables[name].getColumn("monad")
+            else:
+                index.fms[name] = tables[name].getColumn("fm")
+                index.lms[name] = tables[name].getColumn("lm")
+                index.max_lms[name] = tables[name].getColumn("max_lm")
+                index.rows[name] = tables[name].getColumn("row")
+        return index
+
+
+########################################
+##
+## Inverted index
+##
+########################################
+#
+# Per field, each key's posting list: the monads of the tokens with
+# that key, in ascending order, as varint-coded differences (7 bits a
+# byte, low bits first, high bit set on all bytes but the last).  The
+# fields are
+#
+#   consonantal  the consonantal surface, with final letters as medial
+#   surface      the surface as it is
+#   strongs      each /-separated part of the strongs, e.g., "b", "7225"
+#   morph        the morph as it is
+#
+# The index is a columnar file (see "Columnar binary export"): per
+# field a table of the keys, sorted, with the offsets of their posting
+# lists in a table "<field>.postings" of the coded bytes, and a table
+# "verse" of the verses' monads and osisIDs, for references.  wlccolumns.Concordance
+# queries it in place.
+#
+final_letters_table = {
+    0x05da : 0x05db,
+    0x05dd : 0x05de,
+    0x05df : 0x05e0,
+    0x05e3 : 0x05e4,
+    0x05e5 : 0x05e6,
+}
+
+def getNormalizedConsonantal(surface):
+    return getSurfaceVariants(surface)[1].translate(final_letters_table)
+
+
+concordance_fields = {
+    "consonantal" : lambda value: [key for key in [getNormalizedConsonantal(value)] if key != ""],
+    "surface" : lambda value: [value],
+    "strongs" : lambda value: [key.strip() for key in value.split("/") if key.strip() != ""],
+    "morph" : lambda value: [key for key in [value] if key != ""],
+}
+
+
+def encodePostings(monads):
+    out = bytearray()
+    previous = 0
+    for monad in monads:
+        delta = monad - previous
+        previous = monad
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def decodePostings(data):
+    result = array.array('i')
+    previous = 0
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += value
+            result.append(previous)
+            value = 0
+            shift = 0
+    return result
+
+
+class InvertedIndex:
+    def __init__(self):
+        self.postings = {}
+        for field in concordance_fields:
+            self.postings[field] = {}
+        self.verses = []
+
+    def addTokens(self, tokens):
+        # The keys of each distinct value are worked out only once.
+        monads = tokens.monads
+        for (field, column) in [("consonantal", tokens.surfaces), ("surface", tokens.surfaces), ("strongs", tokens.strongs), ("morph", tokens.morphs)]:
+            getKeys = concordance_fields[field]
+            keys_by_code = [getKeys(value) for value in column.values]
+            postings = self.postings[field]
+            for (index, code) in enumerate(column.codes):
+                for key in keys_by_code[code]:
+                    monad_list = postings.get(key)
+                    if monad_list == None:
+                        monad_list = postings[key] = array.array('i')
+                    monad_list.append(monads[index])
+
+    def setVerses(self, verses):
+        self.verses = sorted(verses, key=lambda obj: obj.fm)
+
+    def dump(self, fout):
+        writer = ColumnsWriter(fout)
+        for field in concordance_fields:
+            postings = self.postings[field]
+            keys = sorted(postings.keys())
+            offsets = array.array('i')
+            data = []
+            pos = 0
+            for key in keys:
+                encoded = encodePostings(postings[key])
+                offsets.append(pos)
+                data.append(encoded)
+                pos += len(encoded)
+            writer.addTable(field, len(keys))
+            writer.addColumn(field, "key", "str", array.array('I', [writer.heap.add(key) for key in keys]))
+            writer.addColumn(field, "offset", "int", offsets)
+            writer.addTable(field + ".postings", pos)
+            writer.addColumn(field + ".postings", "data", "bytes", array.array('B', b"".join(data)))
+        writer.addTable("verse", len(self.verses))
+        writer.addColumn("verse", "fm", "int", array.array('i', [obj.fm for obj in self.verses]))
+        writer.addColumn("verse", "lm", "int", array.array('i', [obj.lm for obj in self.verses]))
+        writer.addColumn("verse", "osisID", "str", array.array('I', [writer.heap.add(obj.getStringFeature("osisID").strip()) for obj in self.verses]))
+        writer.close()
+
+
+########################################
+##
+## Book results and monad stitching
+##
+########################################
+class BookResult:
+    # What a worker hands back for one book: everything TanakhHandler
+    # built, with monads and docindexes local to the book (starting at 1).
+    def __init__(self, handler):
+        self.bookname = handler.bookname
+        self.first_monad = handler.first_monad
+        self.monad_count = handler.curmonad - handler.first_monad
+        self.objects = handler.objects
+        self.tokens = handler.tokens
+        self.non_bible_tokens = handler.non_bible_tokens
+        self.stats = handler.stats
+        if handler.aligner != None:
+            self.morphhb_mismatches = handler.aligner.mismatches
+        else:
+            self.morphhb_mismatches = []
+
+    def rebaseMonads(self, offset):
+        if offset == 0:
+            return
+        for objectTypeName in self.objects:
+            for obj in self.objects[objectTypeName]:
+                obj.fm += offset
+                obj.lm += offset
+        self.tokens.rebaseMonads(offset)
+        for token in self.non_bible_tokens:
+            token.monad += offset
+        self.first_monad += offset
+
+
+class Corpus:
+    # Books stitched, in order, into one global monad space.  With a
+    # spooler, the books' objects are passed on to it rather than kept.
+    def __init__(self, spooler=None, stats=None, batch_size=default_batch_size):
+        self.spooler = spooler
+        self.batch_size = batch_size
+        self.stats = stats
+        if self.stats != None:
+            self.stats.startMangling()
+        self.next_monad = 1
+        self.booknames = []
+        self.objects = {}
+        self.tokens = TokenStore()
+        self.non_bible_tokens = []
+        self.morphhb_mismatches = []
+
+    def addBook(self, book):
+        book.rebaseMonads(self.next_monad - book.first_monad)
+        self.next_monad += book.monad_count
+        self.booknames.append(book.bookname)
+        self.morphhb_mismatches.extend(book.morphhb_mismatches)
+        if self.stats != None:
+            self.stats.addBook(book.stats)
+        if self.spooler != None:
+            for objectTypeName in book.objects:
+                for obj in book.objects[objectTypeName]:
+                    self.spooler.addObject(obj)
+            for token in book.tokens:
+                self.spooler.addToken(token)
+            for token in book.non_bible_tokens:
+                self.spooler.addNonBibleToken(token)
+            return
+        for objectTypeName in book.objects:
+            self.objects.setdefault(objectTypeName, []).extend(book.objects[objectTypeName])
+        self.tokens.extend(book.tokens)
+        self.non_bible_tokens.extend(book.non_bible_tokens)
+
+    def dumpMQL(self, fout):
+        if self.spooler != None:
+            self.spooler.dumpMQL(fout, self.stats)
+        else:
+            dumpMQL(fout, self.objects, self.tokens, self.non_bible_tokens, self.stats, self.batch_size)
+        if self.stats != None:
+            self.stats.endMangling()
+
+    def dumpMQLShards(self, outdir):
+        assert self.spooler == None, "Sharding needs the objects, which a spooler does not keep."
+        dumpMQLShards(outdir, self.objects, self.tokens, self.non_bible_tokens, self.batch_size)
+
+    def dumpColumns(self, fout):
+        assert self.spooler == None, "The columnar export needs the objects, which a spooler does not keep."
+        dumpColumns(fout, self.objects, self.tokens)
+
+    def buildMonadIndex(self):
+        assert self.spooler == None, "The monad index needs the objects, which a spooler does not keep."
+        index = MonadIndex()
+        for objectTypeName in sorted(self.objects.keys()):
+            index.addObjects(objectTypeName, self.objects[objectTypeName])
+        index.setTokens(self.tokens)
+        return index
+
+    def buildVerseHashes(self):
+        assert self.spooler == None, "The verse hashes need the objects, which a spooler does not keep."
+        return buildVerseHashes(self.objects, self.tokens)
+
+    def buildInvertedIndex(self):
+        assert self.spooler == None, "The inverted index needs the objects, which a spooler does not keep."
+        index = InvertedIndex()
+        index.addTokens(self.tokens)
+        index.setVerses(self.objects.get("verse", []))
+        return index
+
+    def buildKetivQereTable(self):
+        assert self.spooler == None, "The ketiv/qere table needs the objects, which a spooler does not keep."
+        table = KetivQereTable()
+        table.addObjects(self.objects.get("kq", []))
+        table.build()
+        return table
+
+
+########################################
+##
+## Atomic file output
+##
+########################################
+class AtomicFile:
+    # A file written under a temporary name next to filename, and
+    # renamed over it by commit(), so that a reader never sees half a
+    # file.  abort() removes the temporary file instead.
+    def __init__(self, filename, mode="wb", encoding=None):
+        self.filename = filename
+        self.tmpfilename = filename + ".tmp%d" % os.getpid()
+        self.fout = open(self.tmpfilename, mode, encoding=encoding)
+
+    def commit(self):
+        self.fout.close()
+        try:
+            os.replace(self.tmpfilename, self.filename)
+        except OSError:
+            self.abort()
+            raise
+
+    def abort(self):
+        self.fout.close()
+        try:
+            os.remove(self.tmpfilename)
+        except OSError:
+            pass
+
+
+@contextlib.contextmanager
+def atomicOutput(filename, mode="wb", encoding=None):
+    # with atomicOutput(filename) as fout: ... -- committed if the block
+    # finishes, aborted if it raises.
+    atomic = AtomicFile(filename, mode, encoding)
+    try:
+        yield atomic.fout
+    except BaseException:
+        atomic.abort()
+        raise
+    atomic.commit()
+
+
+########################################
+##
+## Incremental rebuild cache
+##
+########################################
+converter_version = None
+
+def getConverterVersion():
+    # A hash of this very file, so that any change to the converter
+    # invalidates everything in the cache.
+    global converter_version
+    if converter_version == None:
+        fin = open(os.path.abspath(__file__), "rb")
+        converter_version = hashlib.sha256(fin.read()).hexdigest()
+        fin.close()
+    return converter_version
+
+
+class BookCacheUnpickler(pickle.Unpickler):
+    # Entries pickled by the script (as __main__) and by a module that
+    # imports it (as massage_tanakh) are the same classes: load either
+    # as this module's.
+    def find_class(self, module, name):
+        if module in ["__main__", "massage_tanakh"]:
+            module = __name__
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+class BookCache:
+    # Per book, a pickle of its BookResult (with book-local monads) and
+    # a copy of its massaged XML.  The file names carry a hash of the
+    # source XML and of the converter, so a changed book or a changed
+    # converter simply misses.
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def getKey(self, bookname, infilename, morphhbfilename=None):
+        h = hashlib.sha256()
+        h.update(getConverterVersion().encode('ascii'))
+        h.update(bookname.encode('utf-8'))
+        fin = open(infilename, "rb")
+        h.update(fin.read())
+        fin.close()
+        if morphhbfilename != None:
+            fin = open(morphhbfilename, "rb")
+            h.update(fin.read())
+            fin.close()
+        return h.hexdigest()
+
+    def getFilename(self, bookname, key):
+        return os.path.join(self.cachedir, "%s.%s.pickle" % (bookname, key))
+
+    def getXMLFilename(self, bookname, key):
+        return os.path.join(self.cachedir, "%s.%s.xml" % (bookname, key))
+
+    def load(self, bookname, key):
+        # Returns (book, the file name of its massaged XML), or None.
+        filename = self.getFilename(bookname, key)
+        xmlfilename = self.getXMLFilename(bookname, key)
+        if not os.path.exists(filename) or not os.path.exists(xmlfilename):
+            return None
+        try:
+            fin = open(filename, "rb")
+            entry = BookCacheUnpickler(fin).load()
+            fin.close()
+        except Exception as e:
+            sys.stderr.write("WARNING: Ignoring unreadable cache entry %s: %s\n" % (filename, e))
+            return None
+        return (entry["book"], xmlfilename)
+
+    def store(self, bookname, key, book, xmlfilename):
+        filename = self.getFilename(bookname, key)
+
+        # Entries for older versions of the book are of no further use.
+        # (Not a glob: "Genesis.*" would also match Genesis.DH.)
+        old_re = re.compile(r'^%s\.[0-9a-f]{64}\.(pickle|xml)$' % re.escape(bookname))
+        for oldfilename in os.listdir(self.cachedir):
+            if old_re.match(oldfilename) and not oldfilename.startswith("%s.%s." % (bookname, key)):
+                os.remove(os.path.join(self.cachedir, oldfilename))
+
+        if xmlfilename != self.getXMLFilename(bookname, key):
+            copyFileAtomically(xmlfilename, self.getXMLFilename(bookname, key))
+
+        with atomicOutput(filename) as fout:
+            pickle.dump({"book" : book}, fout, pickle.HIGHEST_PROTOCOL)
+
+
+########################################
+##
+## Driver
+##
+########################################
+
+# The 39 books in the order of their UXLC <number>.
+booknames_Tanakh = ["Genesis", "Exodus", "Leviticus", "Numbers", "Deuteronomy", "Joshua", "Judges", "Samuel_1", "Samuel_2", "Kings_1", "Kings_2", "Isaiah", "Jeremiah", "Ezekiel", "Hosea", "Joel", "Amos", "Obadiah", "Jonah", "Micah", "Nahum", "Habakkuk", "Zephaniah", "Haggai", "Zechariah", "Malachi", "Psalms", "Proverbs", "Job", "Song_of_Songs", "Ruth", "Lamentations", "Ecclesiastes", "Esther", "Daniel", "Ezra", "Nehemiah", "Chronicles_1", "Chronicles_2"]
+
+filename2osisBook = {
+    "Genesis" : "Gen",
+    "Exodus" : "Exod",
+    "Leviticus" : "Lev",
+    "Numbers" : "Num",
+    "Deuteronomy" : "Deut",
+    "Joshua" : "Josh",
+    "Judges" : "Judg",
+    "Samuel_1" : "1Sam",
+    "Samuel_2" : "2Sam",
+    "Kings_1" : "1Kgs",
+    "Kings_2" : "2Kgs",
+    "Isaiah" : "Isa",
+    "Jeremiah" : "Jer",
+    "Ezekiel" : "Ezek",
+    "Hosea" : "Hos",
+    "Joel" : "Joel",
+    "Amos" : "Amos",
+    "Obadiah" : "Obad",
+    "Jonah" : "Jonah",
+    "Micah" : "Mic",
+    "Nahum" : "Nah",
+    "Habakkuk" : "Hab",
+    "Zephaniah" : "Zeph",
+    "Haggai" : "Hag",
+    "Zechariah" : "Zech",
+    "Malachi" : "Mal",
+    "Psalms" : "Ps",
+    "Proverbs" : "Prov",
+    "Job" : "Job",
+    "Song_of_Songs" : "Song",
+    "Ruth" : "Ruth",
+    "Lamentations" : "Lam",
+    "Ecclesiastes" : "Eccl",
+    "Esther" : "Esth",
+    "Daniel" : "Dan",
+    "Ezra" : "Ezra",
+    "Nehemiah" : "Neh",
+    "Chronicles_1" : "1Chr",
+    "Chronicles_2" : "2Chr",
+}
+
+
+def convertBook(bookname, indir, xmloutdir, first_monad=1, spooler=None, cachedir=None, parser_backend="expat", bInstrument=False, morphhbdir=None):
+    infilename = os.path.join(indir, '%s.xml' % bookname)
+    if xmloutdir != None:
+        outfilename = os.path.join(xmloutdir, "%s.xml" % bookname)
+    if morphhbdir != None:
+        morphhbfilename = getMorphhbFilename(morphhbdir, bookname)
+    else:
+        morphhbfilename = None
+
+    if cachedir != None:
+        # Cached books have book-local monads; Corpus.addBook rebases them.
+        assert first_monad == 1 and spooler == None
+        cache = BookCache(cachedir)
+        key = cache.getKey(bookname, infilename, morphhbfilename)
+        entry = cache.load(bookname, key)
+        if entry != None:
+            (book, xmlfilename) = entry
+            book.stats = None
+            sys.stderr.write("Using cached: %s\n" % bookname)
+            if xmloutdir != None:
+                copyFileAtomically(xmlfilename, outfilename)
+            return book
+
+    if morphhbfilename != None:
+        aligner = MorphhbAligner(morphhbfilename)
+    else:
+        aligner = None
+
+    if bInstrument:
+        handler = InstrumentedTanakhHandler(bookname, first_monad, spooler, aligner)
+        start = time.perf_counter()
+    else:
+        handler = TanakhHandler(bookname, first_monad, spooler, aligner)
+
+    # The XML goes out as the book is parsed: to its output file, or,
+    # if only the cache wants it, straight into the cache.
+    if xmloutdir != None:
+        sys.stderr.write("Now writing: %s ...\n" % outfilename)
+        xmlfilename = outfilename
+    elif cachedir != None:
+        xmlfilename = cache.getXMLFilename(bookname, key)
+    else:
+        xmlfilename = None
+    if xmlfilename != None:
+        handler.xmlwriter = MassagedXMLWriter(xmlfilename)
+
     fin = open(infilename, "rb")
+    try:
+        parseBook(fin, handler, parser_backend)
+    except BaseException:
+        if handler.xmlwriter != None:
+            handler.xmlwriter.abort()
+        raise
+    finally:
+        fin.close()
 
-    xml.sax.parse(fin, handler)
+    if bInstrument:
+        handler.stats.parse_seconds = time.perf_counter() - start
 
-    outfilename = os.path.join("massaged_tanakh", "%s.xml" % bookname)
-    sys.stderr.write("Now writing: %s ...\n" % outfilename)
-    handler.dumpXML(outfilename)
-    
+    if xmlfilename != None:
+        handler.xmlwriter.close()
+
+    book = BookResult(handler)
+
+    if cachedir != None:
+        cache.store(bookname, key, book, xmlfilename)
+
+    return book
+
+
+def convertBooks(booknames, indir, xmloutdir, jobs, spooler=None, cachedir=None, parser_backend="expat", bInstrument=False, batch_size=default_batch_size, morphhbdir=None):
+    # Each book is parsed on its own, with book-local monads, and then
+    # stitched in the order given.  This way the output does not depend
+    # on the number of jobs, nor on the order in which workers finish.
+    if bInstrument:
+        corpus = Corpus(spooler, RunStats(), batch_size)
+    else:
+        corpus = Corpus(spooler, None, batch_size)
+
+    if jobs <= 1 or len(booknames) <= 1:
+        # Serially, each book can start at the right monad, and a
+        # spooler can take the objects directly from the handler.
+        # Cached books, though, are kept with book-local monads.
+        for bookname in booknames:
+            if cachedir != None:
+                corpus.addBook(convertBook(bookname, indir, xmloutdir, cachedir=cachedir, parser_backend=parser_backend, bInstrument=bInstrument, morphhbdir=morphhbdir))
+            else:
+                corpus.addBook(convertBook(bookname, indir, xmloutdir, corpus.next_monad, spooler, parser_backend=parser_backend, bInstrument=bInstrument, morphhbdir=morphhbdir))
+        return corpus
+
+    convert = functools.partial(convertBook, indir=indir, xmloutdir=xmloutdir, cachedir=cachedir, parser_backend=parser_backend, bInstrument=bInstrument, morphhbdir=morphhbdir)
+
+    # Hand out the biggest books first, so that no worker is left
+    # with Psalms at the very end.
+    sizes = [os.path.getsize(os.path.join(indir, '%s.xml' % bookname)) for bookname in booknames]
+    order = sorted(range(len(booknames)), key=lambda i: -sizes[i])
+
+    pool = multiprocessing.Pool(min(jobs, len(booknames)))
+    try:
+        # Stitch each book as soon as all the books before it are in,
+        # so that we hold on to as few of them as possible.
+        pending = {}
+        next_index = 0
+        for (i, book) in zip(order, pool.imap(convert, [booknames[i] for i in order])):
+            pending[i] = book
+            while next_index in pending:
+                corpus.addBook(pending.pop(next_index))
+                next_index += 1
+    finally:
+        pool.close()
+        pool.join()
+
+    return corpus
+
+
+def selectBooks(bookspecs, indir, bUseDH):
+    # Each spec is a comma-separated list of books and ranges of books,
+    # e.g., "Gen-Deut,Ps" or "Genesis.DH".  Books may be given by file
+    # name or OSIS name, in any case.  "all" is the whole Tanakh.
+    name2bookname = {}
+    for bookname in booknames_Tanakh:
+        name2bookname[bookname.lower()] = bookname
+        name2bookname[filename2osisBook[bookname].lower()] = bookname
+
+    def lookup(name):
+        if name.lower() not in name2bookname:
+            raise ValueError("Unknown book: '%s'" % name)
+        return name2bookname[name.lower()]
+
+    result = []
+    for bookspec in bookspecs:
+        for item in bookspec.split(","):
+            item = item.strip()
+            if item == "":
+                continue
+            elif item.lower() == "all":
+                result.extend(booknames_Tanakh)
+            elif item.endswith(".DH"):
+                result.append(lookup(item[:-3]) + ".DH")
+            elif "-" in item:
+                (first, last) = item.split("-", 1)
+                first_index = booknames_Tanakh.index(lookup(first))
+                last_index = booknames_Tanakh.index(lookup(last))
+                if last_index < first_index:
+                    raise ValueError("Book range is backwards: '%s'" % item)
+                result.extend(booknames_Tanakh[first_index:last_index+1])
+            else:
+                result.append(lookup(item))
+
+    if bUseDH:
+        result = [bookname + ".DH" if not bookname.endswith(".DH") and os.path.exists(os.path.join(indir, "%s.DH.xml" % bookname)) else bookname for bookname in result]
+
+    for bookname in result:
+        infilename = os.path.join(indir, "%s.xml" % bookname)
+        if not os.path.exists(infilename):
+            raise ValueError("No such input file: %s" % infilename)
+
+    return result
+
+
+########################################
+##
+## Verse access
+##
+########################################
+verse_index_re = re.compile(rb'<(names)>|</(names)>|<(c|v)\s+n="(\d+)"[^>]*>|</(v)>')
+
+verse_index_version = 2
+
+class VerseIndex:
+    # Byte offsets of the <names> block and of each <v>...</v> in the
+    # UXLC books, so that a few verses can be had by parsing just those
+    # bytes.  Each book's offsets are kept as JSON in the cache
+    # directory, and rebuilt when the book's size or mtime changes.
+    #
+    # A fragment counts its monads and docindexes from its own start,
+    # so the index also keeps, from one parse of the whole book, the
+    # book-local first monad and first token docindex of each verse,
+    # and the book's monad count, to shift the verses' tokens by.
+    def __init__(self, indir, cachedir):
+        self.indir = indir
+        self.cachedir = cachedir
+        self.books = {}
+
+    def getFilename(self, bookname):
+        return os.path.join(self.cachedir, "%s.verses.json" % bookname)
+
+    def buildBook(self, bookname, infilename):
+        fin = open(infilename, "rb")
+        data = fin.read()
+        fin.close()
+
+        names = [0, 0]
+        verses = {}
+        chapter = ""
+        verse_start = -1
+        verse_key = ""
+        for mo in verse_index_re.finditer(data):
+            if mo.group(1) != None:
+                names[0] = mo.start()
+            elif mo.group(2) != None:
+                names[1] = mo.end()
+            elif mo.group(3) == b"c":
+                chapter = mo.group(4).decode('ascii')
+            elif mo.group(3) == b"v":
+                verse_start = mo.start()
+                verse_key = "%s.%s" % (chapter, mo.group(4).decode('ascii'))
+            else:
+                verses[verse_key] = [verse_start, mo.end()]
+
+        handler = TanakhHandler(bookname)
+        parseBook(io.BytesIO(data), handler, "expat")
+        starts = {}
+        monads = handler.tokens.monads
+        for obj in handler.objects.get("verse", []):
+            index = bisect.bisect_left(monads, obj.fm)
+            if index < len(monads) and monads[index] <= obj.lm:
+                docindex = handler.tokens.docindexes[index]
+            else:
+                docindex = None
+            starts[getVerseKey(obj)] = [obj.fm, docindex]
+        return {"version" : verse_index_version, "names" : names, "verses" : verses, "starts" : starts, "monad_count" : handler.curmonad - handler.first_monad}
+
+    def getBook(self, bookname):
+        if bookname in self.books:
+            return self.books[bookname]
+
+        infilename = os.path.join(self.indir, "%s.xml" % bookname)
+        st = os.stat(infilename)
+        filename = self.getFilename(bookname)
+        book = None
+        if os.path.exists(filename):
+            fin = open(filename, "r")
+            book = json.load(fin)
+            fin.close()
+            if book.get("version") != verse_index_version or book["size"] != st.st_size or book["mtime"] != st.st_mtime_ns:
+                book = None
+        if book == None:
+            book = self.buildBook(bookname, infilename)
+            book["size"] = st.st_size
+            book["mtime"] = st.st_mtime_ns
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+            with atomicOutput(filename, "w") as fout:
+                json.dump(book, fout)
+
+        self.books[bookname] = book
+        return book
+
+    def getMonadOffset(self, bookname):
+        # What to add to the book's own monads to get those of wlc.mql
+        # converted from the whole Tanakh (with --dh, for a .DH book).
+        offset = 0
+        for other in selectBooks(["all"], self.indir, bookname.endswith(".DH")):
+            if other == bookname:
+                return offset
+            offset += self.getBook(other)["monad_count"]
+        raise ValueError("%s is not part of the Tanakh" % bookname)
+
+    def getFragment(self, bookname, chapter, v_from, v_to):
+        # A document holding the book's <names> and the verses asked
+        # for, which TanakhHandler takes like a whole book.
+        book = self.getBook(bookname)
+        verses = book["verses"]
+        for verse in [v_from, v_to]:
+            if "%d.%d" % (chapter, verse) not in verses:
+                raise ValueError("No such verse in %s: %d:%d" % (bookname, chapter, verse))
+        (names_start, names_end) = book["names"]
+        (start, dummy) = verses["%d.%d" % (chapter, v_from)]
+        (dummy, end) = verses["%d.%d" % (chapter, v_to)]
+
+        fin = open(os.path.join(self.indir, "%s.xml" % bookname), "rb")
+        fin.seek(names_start)
+        names = fin.read(names_end - names_start)
+        fin.seek(start)
+        body = fin.read(end - start)
+        fin.close()
+        return b"".join([b"<Tanach><book>", names, b"<c n=\"%d\">" % chapter, body, b"</c></book></Tanach>"])
+
+    def getVerses(self, book, chapter, v_from, v_to=None):
+        if v_to == None:
+            v_to = v_from
+        if v_to < v_from:
+            raise ValueError("Verse range is backwards: %d-%d" % (v_from, v_to))
+        bookname = selectBooks([book], self.indir, False)[0]
+
+        handler = TanakhHandler(bookname)
+        parseBook(io.BytesIO(self.getFragment(bookname, chapter, v_from, v_to)), handler, "expat")
+        starts = self.getBook(bookname)["starts"]
+        offset = self.getMonadOffset(bookname)
+
+        result = []
+        monads = handler.tokens.monads
+        for obj in handler.objects.get("verse", []):
+            start = bisect.bisect_left(monads, obj.fm)
+            end = bisect.bisect_right(monads, obj.lm)
+            tokens = [handler.tokens[index] for index in range(start, end)]
+            (fm, docindex) = starts[getVerseKey(obj)]
+            monad_shift = fm + offset - obj.fm
+            if len(tokens) != 0 and docindex != None:
+                docindex_shift = docindex - tokens[0].docindex
+            else:
+                docindex_shift = 0
+            for token in tokens:
+                token.monad += monad_shift
+                token.docindex += docindex_shift
+            result.append((obj.getStringFeature("osisID").strip(), tokens))
+        return result
+
+
+def getVerseKey(obj):
+    # "Ruth.1.2" -> "1.2", as VerseIndex keys the verses.
+    return ".".join(obj.getStringFeature("osisID").strip().split(".")[-2:])
+
+
+verse_index = None
+
+def get_verses(book, chapter, v_from, v_to=None, indir=None, cachedir=None):
+    # Returns [(osisID, [Token, ...]), ...] for verses v_from to v_to
+    # (default: just v_from) of one chapter.  The book may be given as
+    # in -b, e.g., "Gen", "Genesis" or "Genesis.DH".  The tokens' monads
+    # and docindexes are those of wlc.mql converted from the whole
+    # Tanakh (with --dh, for a .DH book), and so of its monad index.
+    global verse_index
+    if indir == None:
+        indir = os.path.join(script_dir, 'tanach.us', 'Books')
+    if cachedir == None:
+        cachedir = os.path.join(script_dir, "massage_cache")
+    if verse_index == None or verse_index.indir != indir or verse_index.cachedir != cachedir:
+        verse_index = VerseIndex(indir, cachedir)
+    return verse_index.getVerses(book, chapter, v_from, v_to)
+
+
+########################################
+##
+## Watch mode
+##
+########################################
+class WatchedBook:
+    # A book as the watcher keeps it: its BookResult, with monads
+    # rebased into the corpus, and its objects rendered to MQL.  The
+    # renderings stay valid as long as the book stays where it is.
+    def __init__(self, book):
+        self.book = book
+        self.renderings = None
+
+    def render(self):
+        self.renderings = {}
+        for objectTypeName in self.book.objects:
+            self.renderings[objectTypeName] = [obj.renderMQL() for obj in self.book.objects[objectTypeName]]
+        self.renderings["Token"] = list(self.book.tokens.iterMQL())
+        self.renderings["NonBibleToken"] = [obj.renderMQL() for obj in self.book.non_bible_tokens]
+
+
+class WatchService:
+    # Polls the books, the morphhb books and this very file, and once
+    # they have been quiet for `debounce' seconds, converts just the
+    # books that changed, on a process pool, and rewrites wlc.mql from
+    # the books kept in memory.  Only books which have moved, or
+    # changed, are rendered again.  A change to the converter restarts
+    # the whole process, so that the new code is what runs.
+    def __init__(self, booknames, indir, xmloutdir, mqloutfilename, jobs, cachedir=None, parser_backend="expat", batch_size=default_batch_size, morphhbdir=None, debounce=0.2, poll_interval=0.05):
+        self.booknames = booknames
+        self.indir = indir
+        self.xmloutdir = xmloutdir
+        self.mqloutfilename = mqloutfilename
+        self.jobs = jobs
+        self.cachedir = cachedir
+        self.parser_backend = parser_backend
+        self.batch_size = batch_size
+        self.morphhbdir = morphhbdir
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.books = {}
+        self.converter_filename = os.path.abspath(__file__)
+
+        self.filename2booknames = {}
+        for bookname in booknames:
+            self.filename2booknames.setdefault(os.path.join(indir, "%s.xml" % bookname), []).append(bookname)
+            if morphhbdir != None:
+                self.filename2booknames.setdefault(getMorphhbFilename(morphhbdir, bookname), []).append(bookname)
+
+    def getMtimes(self):
+        mtimes = {}
+        for filename in list(self.filename2booknames.keys()) + [self.converter_filename]:
+            try:
+                mtimes[filename] = os.stat(filename).st_mtime_ns
+            except OSError:
+                # In the middle of being replaced by an editor.
+                mtimes[filename] = None
+        return mtimes
+
+    async def convert(self, loop, executor, booknames):
+        convert = functools.partial(convertBook, indir=self.indir, xmloutdir=self.xmloutdir, cachedir=self.cachedir, parser_backend=self.parser_backend, morphhbdir=self.morphhbdir)
+        books = await asyncio.gather(*[loop.run_in_executor(executor, convert, bookname) for bookname in booknames])
+        for (bookname, book) in zip(booknames, books):
+            self.books[bookname] = WatchedBook(book)
+
+    def writeMQL(self):
+        next_monad = 1
+        objectTypeNames = set()
+        for bookname in self.booknames:
+            watched = self.books[bookname]
+            if watched.renderings == None or watched.book.first_monad != next_monad:
+                watched.book.rebaseMonads(next_monad - watched.book.first_monad)
+                watched.render()
+            next_monad += watched.book.monad_count
+            objectTypeNames.update(watched.book.objects.keys())
+
+        with atomicOutput(self.mqloutfilename) as fout:
+            for objectTypeName in sorted(objectTypeNames) + ["Token", "NonBibleToken"]:
+                renderings = itertools.chain.from_iterable([self.books[bookname].renderings.get(objectTypeName, []) for bookname in self.booknames])
+                dumpMQLBatches(fout, objectTypeName, renderings, batch_size=self.batch_size)
+            fout.write("VACUUM DATABASE ANALYZE GO\n".encode('utf-8'))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ProcessPoolExecutor(max(1, self.jobs))
+        try:
+            mtimes = self.getMtimes()
+            await self.convert(loop, executor, self.booknames)
+            if self.mqloutfilename != None:
+                self.writeMQL()
+            sys.stderr.write("Watching %d books; Ctrl-C to stop.\n" % len(self.booknames))
+
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                newmtimes = self.getMtimes()
+                if newmtimes == mtimes:
+                    continue
+
+                # Wait for the edits to settle.
+                while True:
+                    await asyncio.sleep(self.debounce)
+                    settled = self.getMtimes()
+                    if settled == newmtimes:
+                        break
+                    newmtimes = settled
+
+                changed = [filename for filename in newmtimes if newmtimes[filename] != mtimes.get(filename)]
+                mtimes = newmtimes
+                if self.converter_filename in changed:
+                    sys.stderr.write("The converter has changed; restarting.\n")
+                    executor.shutdown()
+                    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+                booknames = []
+                for filename in changed:
+                    for bookname in self.filename2booknames[filename]:
+                        if bookname not in booknames and newmtimes[filename] != None:
+                            booknames.append(bookname)
+                if len(booknames) == 0:
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    await self.convert(loop, executor, booknames)
+                except Exception as e:
+                    # Most likely a half-edited book; keep the old
+                    # outputs and wait for the next change.
+                    sys.stderr.write("ERROR: Could not convert %s: %s\n" % (", ".join(booknames), e))
+                    continue
+                if self.mqloutfilename != None:
+                    self.writeMQL()
+                sys.stderr.write("Rebuilt %s in %.3f s\n" % (", ".join(booknames), time.perf_counter() - start))
+        finally:
+            executor.shutdown()
+
+
+output_formats = ["mql", "xml", "columns", "index", "shards", "kq", "hashes", "concordance"]
+
+default_output_formats = ["mql", "xml"]
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description="Convert the UXLC books to massaged XML and MQL.")
+    argparser.add_argument("-b", "--books", action="append", default=[],
+                           help="books to convert, e.g., 'Gen-Deut,Ps' or 'Genesis.DH'; may be repeated (default: all)")
+    argparser.add_argument("--dh", dest="bUseDH", action="store_true",
+                           help="use the .DH.xml variant of a book wherever there is one")
+    argparser.add_argument("-i", "--indir", default=os.path.join(script_dir, 'tanach.us', 'Books'),
+                           help="directory with the UXLC book files (default: %(default)s)")
+    argparser.add_argument("--xml-outdir", default=os.path.join(script_dir, "massaged_tanakh"),
+                           help="directory for the massaged XML (default: %(default)s)")
+    argparser.add_argument("-o", "--mql-output", default=os.path.join(script_dir, "wlc.mql"),
+                           help="MQL file to write (default: %(default)s)")
+    argparser.add_argument("--columns-output", default=os.path.join(script_dir, "wlc.columns"),
+                           help="memory-mappable columnar file to write (default: %(default)s)")
+    argparser.add_argument("--index-output", default=os.path.join(script_dir, "wlc.monadindex"),
+                           help="monad-range index to write (default: %(default)s)")
+    argparser.add_argument("--kq-output", default=os.path.join(script_dir, "wlc_kq.tsv"),
+                           help="file for the table of ketiv/qere pairs (default: %(default)s)")
+    argparser.add_argument("--concordance-output", default=os.path.join(script_dir, "wlc.concordance"),
+                           help="file for the inverted index (default: %(default)s)")
+    argparser.add_argument("--hashes-output", default=os.path.join(script_dir, "wlc_hashes.json"),
+                           help="file for the verse hashes (default: %(default)s)")
+    argparser.add_argument("--diff-hashes", nargs=2, metavar=("OLD", "NEW"),
+                           help="list the verses that differ between two verse-hash files, and exit")
+    argparser.add_argument("--shards-outdir", default=os.path.join(script_dir, "wlc_shards"),
+                           help="directory for the MQL shards and their manifest (default: %(default)s)")
+    argparser.add_argument("--batch-size", type=int, default=default_batch_size,
+                           help="objects per transaction in the MQL and in each shard (default: %(default)s)")
+    argparser.add_argument("-f", "--format", dest="formats", action="append", choices=output_formats,
+                           help="output to write; may be repeated (default: %s)" % ", ".join(default_output_formats))
+    argparser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                           help="number of books to convert in parallel (default: %(default)s)")
+    argparser.add_argument("--cache-dir", default=os.path.join(script_dir, "massage_cache"),
+                           help="directory for the rebuild cache (default: %(default)s)")
+    argparser.add_argument("--no-cache", dest="bUseCache", action="store_false",
+                           help="parse every book, and leave the cache alone")
+    argparser.add_argument("--parser", dest="parser_backend", choices=parser_backends, default="expat",
+                           help="XML parser to drive TanakhHandler with (default: expat)")
+    argparser.add_argument("--stats", dest="bInstrument", action="store_true",
+                           help="count elements, objects, buffer sizes and cache hits, time the dump, and print a summary at the end")
+    argparser.add_argument("--morphhb", dest="morphhbdir", nargs="?", const=os.path.join(script_dir, "morphhb", "wlc"), default=None,
+                           help="take morph, strongs and language from the morphhb books in this directory (default if given without a directory: %(const)s)")
+    argparser.add_argument("--morphhb-mismatches", default=os.path.join(script_dir, "morphhb_mismatches.tsv"),
+                           help="where to list the words that did not align with morphhb (default: %(default)s)")
+    argparser.add_argument("--watch", dest="bWatch", action="store_true",
+                           help="keep running, and rebuild the MQL and XML of each book whose input changes")
+    args = argparser.parse_args(argv)
+
+    if args.diff_hashes != None:
+        (old, new) = [readVerseHashes(filename) for filename in args.diff_hashes]
+        differences = diffVerseHashes(old, new)
+        for (status, osisID) in differences:
+            sys.stdout.write("%s\t%s\n" % (status, osisID))
+        chapters = set([osisID.rsplit(".", 1)[0] for (status, osisID) in differences])
+        sys.stderr.write("%d verses differ, in %d chapters\n" % (len(differences), len(chapters)))
+        return
+
+    if len(args.books) == 0:
+        args.books = ["all"]
+    if args.formats == None:
+        args.formats = default_output_formats
+    if args.batch_size < 1:
+        argparser.error("--batch-size must be at least 1")
+    if args.bWatch and len(set(args.formats) - set(["mql", "xml"])) != 0:
+        argparser.error("--watch can only keep the mql and xml formats up to date")
+
+    try:
+        booknames = selectBooks(args.books, args.indir, args.bUseDH)
+    except ValueError as e:
+        argparser.error(str(e))
+
+    if args.morphhbdir != None:
+        for bookname in booknames:
+            if not os.path.exists(getMorphhbFilename(args.morphhbdir, bookname)):
+                argparser.error("No morphhb book for %s: %s" % (bookname, getMorphhbFilename(args.morphhbdir, bookname)))
+
+    if "xml" in args.formats:
+        xmloutdir = args.xml_outdir
+        if not os.path.isdir(xmloutdir):
+            os.makedirs(xmloutdir)
+    else:
+        xmloutdir = None
+
+    if args.bUseCache:
+        cachedir = args.cache_dir
+    else:
+        cachedir = None
+
+    if args.bWatch:
+        if "mql" in args.formats:
+            mqloutfilename = args.mql_output
+        else:
+            mqloutfilename = None
+        service = WatchService(booknames, args.indir, xmloutdir, mqloutfilename, args.jobs, cachedir, args.parser_backend, args.batch_size, args.morphhbdir)
+        try:
+            asyncio.run(service.run())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # The columnar export and the index need all the objects in memory,
+    # so they cannot be combined with streaming the MQL.
+    bNeedsObjects = "columns" in args.formats or "index" in args.formats or "shards" in args.formats or "kq" in args.formats or "hashes" in args.formats or "concordance" in args.formats
+    if "mql" in args.formats and not bNeedsObjects:
+        spooler = MQLSpooler(args.batch_size, args.bInstrument)
+    else:
+        spooler = None
+
+    corpus = convertBooks(booknames, args.indir, xmloutdir, args.jobs, spooler, cachedir, args.parser_backend, args.bInstrument, args.batch_size, args.morphhbdir)
+
+    if args.morphhbdir != None:
+        writeMorphhbMismatches(args.morphhb_mismatches, corpus.morphhb_mismatches)
+        sys.stderr.write("Words not aligned with morphhb: %d (see %s)\n" % (len(corpus.morphhb_mismatches), args.morphhb_mismatches))
+
+    if "mql" in args.formats:
+        with atomicOutput(args.mql_output) as fout:
+            corpus.dumpMQL(fout)
+
+    if "shards" in args.formats:
+        corpus.dumpMQLShards(args.shards_outdir)
+
+    if "kq" in args.formats:
+        with atomicOutput(args.kq_output, "w", "utf-8") as fout:
+            corpus.buildKetivQereTable().dump(fout)
+
+    if "concordance" in args.formats:
+        with atomicOutput(args.concordance_output) as fout:
+            corpus.buildInvertedIndex().dump(fout)
+
+    if "hashes" in args.formats:
+        writeVerseHashes(args.hashes_output, corpus.buildVerseHashes())
+
+    if "columns" in args.formats:
+        with atomicOutput(args.columns_output) as fout:
+            corpus.dumpColumns(fout)
+
+    if "index" in args.formats:
+        with atomicOutput(args.index_output) as fout:
+            corpus.buildMonadIndex().dump(fout)
+
+    if spooler != None:
+        spooler.close()
+
+    if args.bInstrument:
+        corpus.stats.endMangling()
+        corpus.stats.writeSummary(sys.stderr)
 
-fout = open("wlc.mql", "wb")
-handler.dumpMQL(fout)
-fout.close()
 
+if __name__ == "__main__":
+    main()
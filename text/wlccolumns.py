@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+import sys
+import mmap
+import json
+import struct
+import bisect
+import array
+
+import massage_tanakh
+
+
+########################################
+##
+## Reader for the columnar export
+##
+########################################
+#
+# See "Columnar binary export" in massage_tanakh.py for the layout.
+# Columns are memoryviews straight into the mmap'ed file; Token and
+# SRObject views are only built when asked for.
+#
+class ColumnTable:
+    def __init__(self, reader, name, info):
+        self.reader = reader
+        self.name = name
+        self.count = info["count"]
+        self.column_info = info["columns"]
+        self.string_features = info["string_features"]
+        self.non_string_features = info["non_string_features"]
+        self.columns = {}
+
+    def __len__(self):
+        return self.count
+
+    def hasColumn(self, name):
+        return name in self.column_info
+
+    def getColumn(self, name):
+        if name not in self.columns:
+            info = self.column_info[name]
+            if info["kind"] == "str":
+                typecode = 'I'
+            elif info["kind"] == "bytes":
+                typecode = 'B'
+            else:
+                typecode = 'i'
+            self.columns[name] = self.reader.getArray(info["pos"], self.count, typecode)
+        return self.columns[name]
+
+    def getValue(self, name, index):
+        kind = self.column_info[name]["kind"]
+        value = self.getColumn(name)[index]
+        if kind == "int":
+            return value
+        elif kind == "intstr":
+            return str(value)
+        elif value == massage_tanakh.columns_missing:
+            return None
+        else:
+            return self.reader.getString(value)
+
+
+class ColumnsReader:
+    def __init__(self, filename):
+        if sys.byteorder != "little":
+            raise Exception("ERROR: Reading %s in place needs a little-endian machine." % filename)
+
+        self.f = open(filename, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm)
+        self.views = []
+
+        magic_length = len(massage_tanakh.columns_magic)
+        if bytes(self.mm[0:magic_length]) != massage_tanakh.columns_magic:
+            self.close()
+            raise Exception("ERROR: %s is not a columnar export." % filename)
+        (directory_pos, directory_length) = struct.unpack("<QQ", self.mm[magic_length:magic_length+16])
+        directory = json.loads(self.mm[directory_pos:directory_pos+directory_length].decode('utf-8'))
+        if directory["version"] != massage_tanakh.columns_version:
+            self.close()
+            raise Exception("ERROR: %s has version %s; expected %d." % (filename, directory["version"], massage_tanakh.columns_version))
+
+        strings = directory["strings"]
+        self.string_offsets = self.getArray(strings["offsets"], strings["count"] + 1, 'I')
+        self.string_data = strings["data"]
+
+        self.tables = {}
+        for name in directory["tables"]:
+            self.tables[name] = ColumnTable(self, name, directory["tables"][name])
+
+        self.verse_index = None
+
+    def getArray(self, pos, count, typecode):
+        view = self.view[pos:pos + struct.calcsize(typecode)*count].cast(typecode)
+        self.views.append(view)
+        return view
+
+    def getString(self, index):
+        start = self.string_data + self.string_offsets[index]
+        end = self.string_data + self.string_offsets[index + 1]
+        return str(self.mm[start:end], 'utf-8')
+
+    def getTable(self, name):
+        return self.tables[name]
+
+    def getToken(self, index):
+        t = self.tables["Token"]
+        return massage_tanakh.Token(t.getValue("monad", index), t.getValue("surface", index), t.getValue("morph", index), t.getValue("strongs", index), t.getValue("word_id", index), t.getValue("word_type", index), t.getValue("word_n", index), t.getValue("language", index), t.getValue("docindex", index))
+
+    def iterTokens(self, start, end):
+        for index in range(start, end):
+            yield self.getToken(index)
+
+    def getObject(self, objectTypeName, index):
+        t = self.tables[objectTypeName]
+        obj = massage_tanakh.SRObject(objectTypeName, t.getValue("fm", index))
+        obj.lm = t.getValue("lm", index)
+        obj.id_d = t.getValue("id_d", index)
+        for name in t.non_string_features:
+            value = t.getValue("non_string_features:" + name, index)
+            if value != None:
+                obj.setNonStringFeature(name, value)
+        for name in t.string_features:
+            value = t.getValue("string_features:" + name, index)
+            if value != None:
+                obj.setStringFeature(name, value)
+        return obj
+
+    def iterObjects(self, objectTypeName):
+        for index in range(len(self.tables[objectTypeName])):
+            yield self.getObject(objectTypeName, index)
+
+    def getTokenRange(self, first_monad, last_monad):
+        # Token indexes [start, end) covering the monads, which are in
+        # ascending order.
+        monads = self.tables["Token"].getColumn("monad")
+        return (bisect.bisect_left(monads, first_monad), bisect.bisect_right(monads, last_monad))
+
+    def findVerse(self, osisBook, chapter, verse):
+        if self.verse_index == None:
+            t = self.tables["verse"]
+            self.verse_index = {}
+            for index in range(len(t)):
+                key = (t.getValue("string_features:osisBook", index), str(t.getValue("non_string_features:chapter", index)), str(t.getValue("non_string_features:verse", index)))
+                self.verse_index[key] = index
+        return self.verse_index.get((osisBook, str(chapter), str(verse)))
+
+    def getVerseTokens(self, osisBook, chapter, first_verse, last_verse):
+        # The token index range [start, end) of a range of verses within
+        # one chapter; slice any column with it to read them in place.
+        first = self.findVerse(osisBook, chapter, first_verse)
+        last = self.findVerse(osisBook, chapter, last_verse)
+        if first == None or last == None:
+            raise KeyError("No such verses: %s %s:%s-%s" % (osisBook, chapter, first_verse, last_verse))
+        verses = self.tables["verse"]
+        return self.getTokenRange(verses.getColumn("fm")[first], verses.getColumn("lm")[last])
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        self.views = []
+        self.view.release()
+        self.mm.close()
+        self.f.close()
+
+
+def loadMonadIndex(filename):
+    # The index written by MonadIndex.dump(), queried in place.  Keep
+    # the reader open for as long as the index is in use.
+    reader = ColumnsReader(filename)
+    return (massage_tanakh.MonadIndex.fromColumns(reader.tables), reader)
+
+
+class Concordance:
+    # The inverted index written by massage_tanakh.InvertedIndex.dump(),
+    # queried in place.  A term is a (field, key) pair; consonantal keys
+    # may be given pointed or with final letters, as they are
+    # normalized the way the index was.
+    def __init__(self, filename):
+        self.reader = ColumnsReader(filename)
+        self.keys = {}
+        verses = self.reader.getTable("verse")
+        self.verse_fms = verses.getColumn("fm")
+        self.verse_lms = verses.getColumn("lm")
+
+    def getFields(self):
+        return list(massage_tanakh.concordance_fields.keys())
+
+    def findKey(self, field, key):
+        # The key's row in the field's table, or -1.
+        if field == "consonantal":
+            key = massage_tanakh.getNormalizedConsonantal(key)
+        if field not in self.keys:
+            self.keys[field] = KeyColumn(self.reader, self.reader.getTable(field))
+        keys = self.keys[field]
+        row = bisect.bisect_left(keys, key)
+        if row < len(keys) and keys[row] == key:
+            return row
+        return -1
+
+    def getPostingsData(self, field, key):
+        # The coded posting list of the key, which is empty if the key
+        # is not in the index.
+        data = self.reader.getTable(field + ".postings").getColumn("data")
+        row = self.findKey(field, key)
+        if row < 0:
+            return data[0:0]
+        table = self.reader.getTable(field)
+        offsets = table.getColumn("offset")
+        if row + 1 < len(table):
+            return data[offsets[row]:offsets[row + 1]]
+        return data[offsets[row]:]
+
+    def getPostings(self, field, key):
+        # The monads of the tokens with the key, in ascending order.
+        return massage_tanakh.decodePostings(self.getPostingsData(field, key))
+
+    def getCount(self, field, key):
+        return len(self.getPostings(field, key))
+
+    def getSize(self, term):
+        # The coded length of a term's posting list, which goes with its
+        # length, for ordering intersections.
+        return len(self.getPostingsData(term[0], term[1]))
+
+    def find(self, terms):
+        # The monads of the tokens matching all the terms, intersecting
+        # from the shortest posting list up.
+        terms = sorted(terms, key=self.getSize)
+        if len(terms) == 0:
+            return array.array('i')
+        result = self.getPostings(terms[0][0], terms[0][1])
+        for (field, key) in terms[1:]:
+            if len(result) == 0:
+                break
+            monads = set(self.getPostings(field, key))
+            result = array.array('i', [monad for monad in result if monad in monads])
+        return result
+
+    def getVerseRow(self, monad):
+        # The row of the verse containing the monad, or -1.
+        row = bisect.bisect_right(self.verse_fms, monad) - 1
+        if row >= 0 and monad <= self.verse_lms[row]:
+            return row
+        return -1
+
+    def getReferences(self, monads):
+        # [(osisID, [monad, ...])], one per verse, for ascending monads.
+        verses = self.reader.getTable("verse")
+        result = []
+        last_row = -1
+        for monad in monads:
+            row = self.getVerseRow(monad)
+            if row < 0:
+                continue
+            if row != last_row:
+                result.append((verses.getValue("osisID", row), []))
+                last_row = row
+            result[-1][1].append(monad)
+        return result
+
+    def findVerses(self, terms):
+        # The osisIDs of the verses in which every term occurs, though
+        # not necessarily on the same token.
+        rows = None
+        for (field, key) in sorted(terms, key=self.getSize):
+            term_rows = set([self.getVerseRow(monad) for monad in self.getPostings(field, key)])
+            term_rows.discard(-1)
+            if rows == None:
+                rows = term_rows
+            else:
+                rows &= term_rows
+            if len(rows) == 0:
+                break
+        verses = self.reader.getTable("verse")
+        return [verses.getValue("osisID", row) for row in sorted(rows or [])]
+
+    def close(self):
+        self.keys = {}
+        self.verse_fms = None
+        self.verse_lms = None
+        self.reader.close()
+
+
+class KeyColumn:
+    # The sorted keys of a concordance field, as a sequence of strings
+    # decoded when looked at, for bisecting.
+    def __init__(self, reader, table):
+        self.reader = reader
+        self.column = table.getColumn("key")
+
+    def __getitem__(self, row):
+        return self.reader.getString(self.column[row])
+
+    def __len__(self):
+        return len(self.column)
+
+
+def main():
+    if len(sys.argv) != 6:
+        sys.stderr.write("Usage:\n     python wlccolumns.py wlc.columns osisBook chapter first_verse last_verse\n")
+        sys.exit(1)
+    reader = ColumnsReader(sys.argv[1])
+    (start, end) = reader.getVerseTokens(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+    sys.stdout.write(" ".join([token.surface for token in reader.iterTokens(start, end)]) + "\n")
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()